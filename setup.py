@@ -20,6 +20,9 @@ setup(
         'pywin32; platform_system=="Windows"',
         'wmi; platform_system=="Windows"',
     ],
+    extras_require={
+        'libusb': ['libusb1'],
+    },
 
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -9,11 +9,28 @@ Email: eric@ericcanas.com
 Github: https://github.com/Eric-Canas
 """
 
+import re
+
 from ..attributes import ID_MODEL_ID, ID_VENDOR, ID_MODEL, ID_VENDOR_FROM_DATABASE, ID_MODEL_FROM_DATABASE, \
-    DEVNAME, ID_USB_CLASS_FROM_DATABASE, ID_USB_INTERFACES, DEVTYPE, ID_VENDOR_ID, ID_SERIAL
+    DEVNAME, ID_USB_CLASS_FROM_DATABASE, ID_USB_INTERFACES, DEVTYPE, ID_VENDOR_ID, ID_SERIAL, ID_REVISION
 
 _SECONDS_BETWEEN_CHECKS = 0.5
 _THREAD_JOIN_TIMEOUT_SECONDS = 5
+# Growth factor of the interval between checks while no changes are detected (when max_check_every_seconds is set)
+_IDLE_BACKOFF_FACTOR = 1.5
+# If the polling loop falls behind its schedule by more than this, it stops trying to catch up
+_MAX_CHECKS_DELAY_SECONDS = 5
+# Maximum number of device events waiting for their callback to be executed
+_CALLBACKS_QUEUE_MAX_SIZE = 1024
+# Kinds of device events put in the callbacks queue
+_CONNECT_EVENT, _DISCONNECT_EVENT = 'connect', 'disconnect'
+# Scheduling used for the monitor thread when its priority is raised
+_LINUX_MONITOR_RR_PRIORITY, _LINUX_MONITOR_NICE_INCREMENT = 1, -10
+_WINDOWS_THREAD_PRIORITY_ABOVE_NORMAL = 1
+
+# Optional backends
+_LIBUSB_BACKEND = 'libusb'
+_LIBUSB_DEVICE_ID_FORMAT = "{bus:03d}/{address:03d}"
 
 _DEVICE_ID, _PNP_DEVICE_ID = 'DeviceID', 'PNPDeviceID'
 
@@ -30,29 +47,57 @@ _LINUX_TO_WINDOWS_ATTRIBUTES = {
     DEVTYPE: _PNP_DEVICE_ID,
     ID_SERIAL: _PNP_DEVICE_ID
 }
+# Precomputed (linux_attribute, windows_attribute) pairs, iterated for every device in every query
+_LINUX_TO_WINDOWS_ATTRIBUTES_ITEMS = tuple(_LINUX_TO_WINDOWS_ATTRIBUTES.items())
 
 _LINUX_TUPLE_ATTRIBUTES_SEPARATORS = {ID_USB_INTERFACES: ':'}
+_LINUX_TUPLE_ATTRIBUTES_SEPARATORS_ITEMS = tuple(_LINUX_TUPLE_ATTRIBUTES_SEPARATORS.items())
+# Attributes that identify the physical device behind a DEVNAME, to know when its cached information can be reused
+_LINUX_DEVICE_FINGERPRINT_ATTRIBUTES = (ID_VENDOR_ID, ID_MODEL_ID, ID_SERIAL, ID_REVISION)
 
 USB, USBSTOR, USB4, USBPRINT = 'USB', 'USBSTOR', 'USB4', 'USBPRINT'
 
-_WINDOWS_USB_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_([0-9A-Fa-f]{4})', ID_VENDOR_ID: r'VID_([0-9A-Fa-f]{4})',
-                                 DEVTYPE: r'^(.+?)\\', ID_SERIAL: r'\\([^\\]+)$'}
-_WINDOWS_USB4_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_([0-9A-Fa-f]{4})', ID_VENDOR_ID: r'VID_([0-9A-Fa-f]{4})',
-                                  DEVTYPE: r'^(.+?)\\', ID_SERIAL: r'\\([^\\]+)$'}
-_WINDOWS_USBPRINT_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_([0-9A-Fa-f]{4})', ID_VENDOR_ID: r'VID_([0-9A-Fa-f]{4})',
-                                        DEVTYPE: r'^(.+?)\\', ID_SERIAL: r'\\([^\\]+)$'}
-_WINDOWS_USBSTOR_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PROD_([a-zA-Z0-9\_\/\.\-]{2,16})&', ID_VENDOR_ID: r'VEN_([a-zA-Z0-9\.\_\-\/]{2,8})&',
-                                     DEVTYPE: r'^(.+?)\\', ID_SERIAL: r'\\([^\\]+)$'}
+# Each value is captured by a group named as its attribute. DEVTYPE and ID_SERIAL are the first and last components
+# of the device ID, so they are split without regex
+_WINDOWS_USB_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_(?P<ID_MODEL_ID>[0-9A-Fa-f]{4})',
+                                 ID_VENDOR_ID: r'VID_(?P<ID_VENDOR_ID>[0-9A-Fa-f]{4})'}
+_WINDOWS_USB4_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_(?P<ID_MODEL_ID>[0-9A-Fa-f]{4})',
+                                  ID_VENDOR_ID: r'VID_(?P<ID_VENDOR_ID>[0-9A-Fa-f]{4})'}
+_WINDOWS_USBPRINT_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PID_(?P<ID_MODEL_ID>[0-9A-Fa-f]{4})',
+                                      ID_VENDOR_ID: r'VID_(?P<ID_VENDOR_ID>[0-9A-Fa-f]{4})'}
+_WINDOWS_USBSTOR_REGEX_ATTRIBUTES = {ID_MODEL_ID: r'PROD_(?P<ID_MODEL_ID>[a-zA-Z0-9\_\/\.\-]{2,16})&',
+                                     ID_VENDOR_ID: r'VEN_(?P<ID_VENDOR_ID>[a-zA-Z0-9\.\_\-\/]{2,8})&'}
 
 _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER = {USB: _WINDOWS_USB_REGEX_ATTRIBUTES,
                                        USBSTOR: _WINDOWS_USBSTOR_REGEX_ATTRIBUTES,
                                        USB4: _WINDOWS_USB4_REGEX_ATTRIBUTES,
                                        USBPRINT: _WINDOWS_USBPRINT_REGEX_ATTRIBUTES}
+# The patterns of each driver fused into a single alternation (compiled once at import time), so the device ID is
+# scanned only once. The name of the group captured by each match (match.lastgroup) is the attribute it found
+_WINDOWS_FUSED_REGEX_BY_DRIVER = {driver: re.compile('|'.join(regex_attributes.values()))
+                                  for driver, regex_attributes in _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER.items()}
 
 _WINDOWS_TO_LOWERCASE_ATTRIBUTES = (ID_MODEL_ID, ID_VENDOR_ID)
+# Cheap attributes compared to detect when a device that stays connected changed (e.g. once its driver is installed)
+_WINDOWS_DEVICE_FINGERPRINT_ATTRIBUTES = ('Name', 'PNPClass')
 _WINDOWS_NON_USB_DEVICES_IDS = ("ROOT_HUB20", "ROOT_HUB30", "VIRTUAL_POWER_PDO")
-_WINDOWS_USB_QUERY = f"SELECT {', '.join(set(_LINUX_TO_WINDOWS_ATTRIBUTES.values()))} FROM Win32_PnPEntity " \
-                          f"WHERE {_PNP_DEVICE_ID} LIKE 'USB%'"
+# Only the required columns are retrieved (deduplicated, in a stable order). 'USB%' is a prefix match that covers
+# the USB, USBSTOR, USB4 and USBPRINT drivers. Non USB devices are excluded by WMI itself ('_' is escaped as '[_]',
+# as it is a single character wildcard in WQL)
+_WINDOWS_USB_QUERY = f"SELECT {', '.join(dict.fromkeys(_LINUX_TO_WINDOWS_ATTRIBUTES.values()))} " \
+                     f"FROM Win32_PnPEntity WHERE {_PNP_DEVICE_ID} LIKE 'USB%'" + \
+                     ''.join(f" AND NOT {_PNP_DEVICE_ID} LIKE '%{device_id.replace('_', '[_]')}%'"
+                             for device_id in _WINDOWS_NON_USB_DEVICES_IDS)
+# Notifies the creation or deletion of any USB Win32_PnPEntity. WMI checks for them every _WINDOWS_EVENTS_WITHIN_SECONDS
+_WINDOWS_EVENTS_WITHIN_SECONDS = 1
+_WINDOWS_USB_EVENTS_QUERY = f"SELECT * FROM __InstanceOperationEvent WITHIN {_WINDOWS_EVENTS_WITHIN_SECONDS} " \
+                            f"WHERE (__CLASS = '__InstanceCreationEvent' OR __CLASS = '__InstanceDeletionEvent') " \
+                            f"AND TargetInstance ISA 'Win32_PnPEntity' AND TargetInstance.{_PNP_DEVICE_ID} LIKE 'USB%'"
+# Hidden window that receives the WM_DEVICECHANGE notifications of the USB device interfaces
+_WINDOWS_NOTIFICATION_WINDOW_CLASS = "USBMonitorDeviceNotifications"
+# Seconds to keep checking for changes after a device notification, as the child devices of a USB device (e.g.
+# USBSTOR disks or MI_xx interfaces) can show up in Win32_PnPEntity later, without sending a notification of their own
+_WINDOWS_DEVICE_SETTLE_SECONDS = 5
 
 # Darwin-specific constants
 _DARWIN_TO_LINUX_ATTRIBUTES = {
@@ -69,7 +114,20 @@ _DARWIN_TO_LINUX_ATTRIBUTES = {
     ID_SERIAL: 'kUSBSerialNumberString',
 }
 
+# Inverse mapping, and a single pattern that finds all the Darwin attributes of a line in one scan. The names of the
+# _DARWIN_REGEX_ATTRIBUTES are included in it, so lines without any match can be skipped at once
+_LINUX_BY_DARWIN_ATTRIBUTES = {darwin_attr: attribute for attribute, darwin_attr in _DARWIN_TO_LINUX_ATTRIBUTES.items()}
+_DARWIN_ATTRIBUTES_REGEX = re.compile('|'.join(re.escape(darwin_attr) for darwin_attr in _LINUX_BY_DARWIN_ATTRIBUTES))
+
 _DARWIN_REGEX_ATTRIBUTES = {
-    ID_MODEL_ID: r'idProduct: ([0-9A-Fa-f]{4})',
-    ID_VENDOR_ID: r'idVendor: ([0-9A-Fa-f]{4})'
+    ID_MODEL_ID: re.compile(r'idProduct: ([0-9A-Fa-f]{4})'),
+    ID_VENDOR_ID: re.compile(r'idVendor: ([0-9A-Fa-f]{4})')
 }
+_DARWIN_DEVICE_ID_REGEX = re.compile(r"\+-o\s+(.+?)\s+<")
+# I/O Registry access through IOKit
+_DARWIN_IOKIT_USB_DEVICE_CLASS, _DARWIN_IOKIT_USB_PLANE = b'IOUSBHostDevice', b'IOUSB'
+_DARWIN_IOKIT_NAME_LENGTH, _DARWIN_IOKIT_STRING_LENGTH = 128, 1024
+# kIOFirstMatchNotification and kIOTerminatedNotification, notified when a USB device is connected or disconnected
+_DARWIN_IOKIT_NOTIFICATION_TYPES = (b'IOServiceFirstMatch', b'IOServiceTerminate')
+# Numeric IDs that IOKit returns as integers, and are formatted as 4 hex digits (as in Linux)
+_DARWIN_HEX_ATTRIBUTES = (ID_MODEL_ID, ID_VENDOR_ID)
@@ -0,0 +1,231 @@
+"""
+_IOKit: Minimal ctypes bindings to the IOKit and CoreFoundation frameworks of MacOS. They are used by the
+_DarwinUSBDetector to read the USB devices directly from the I/O Registry, without launching the ioreg command and
+parsing its text output.
+"""
+
+from __future__ import annotations
+import ctypes
+import ctypes.util
+
+from ._constants import _DARWIN_IOKIT_USB_DEVICE_CLASS, _DARWIN_IOKIT_USB_PLANE, _DARWIN_IOKIT_NAME_LENGTH, \
+    _DARWIN_IOKIT_STRING_LENGTH, _DARWIN_IOKIT_NOTIFICATION_TYPES
+
+# IOKit / CoreFoundation constants
+_KERN_SUCCESS, _MACH_PORT_NULL = 0, 0
+_CF_STRING_ENCODING_UTF8, _CF_NUMBER_SINT64_TYPE = 0x08000100, 4
+# void (*IOServiceMatchingCallback)(void *refcon, io_iterator_t iterator)
+_IO_SERVICE_MATCHING_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32)
+
+
+class _IOKit:
+    def __init__(self, property_names: tuple[str, ...] | list[str]):
+        """
+        Loads the IOKit and CoreFoundation frameworks.
+        :param property_names: tuple[str, ...] | list[str]. The names of the I/O Registry properties to read from
+                each device.
+        :raises OSError: If the frameworks are not available (i.e. not running on MacOS).
+        """
+        self.iokit = self.__load_library(name='IOKit')
+        self.cf = self.__load_library(name='CoreFoundation')
+        self.__declare_functions()
+        self._cf_string_type_id = self.cf.CFStringGetTypeID()
+        self._cf_number_type_id = self.cf.CFNumberGetTypeID()
+        self._cf_boolean_type_id = self.cf.CFBooleanGetTypeID()
+        self._run_loop_default_mode = ctypes.c_void_p.in_dll(self.cf, 'kCFRunLoopDefaultMode')
+        # Notifications port, callback (must be kept alive while registered) and iterators of the USB notifications
+        self._notification_port, self._notification_callback, self._notification_iterators = None, None, []
+        # CFString keys are created once, and kept alive as long as this object
+        self._property_keys = {name: self.cf.CFStringCreateWithCString(None, name.encode('utf-8'),
+                                                                       _CF_STRING_ENCODING_UTF8)
+                               for name in property_names}
+
+    def __del__(self):
+        for key in getattr(self, '_property_keys', {}).values():
+            self.cf.CFRelease(key)
+
+    def get_usb_devices(self) -> dict[str, dict[str, str]]:
+        """
+        Returns the USB devices of the I/O Registry.
+        :return: dict[str, dict[str, str]]. The key is the device ID (name@location, as shown by ioreg), the value is a
+                dictionary with the requested properties that the device has, as strings.
+        :raises OSError: If the I/O Registry could not be queried.
+        """
+        iterator = ctypes.c_uint32()
+        # IOServiceGetMatchingServices consumes the matching dictionary reference
+        matching = self.iokit.IOServiceMatching(_DARWIN_IOKIT_USB_DEVICE_CLASS)
+        result = self.iokit.IOServiceGetMatchingServices(_MACH_PORT_NULL, matching, ctypes.byref(iterator))
+        if result != _KERN_SUCCESS:
+            raise OSError(f"IOServiceGetMatchingServices failed with error {result}")
+        try:
+            return self.read_devices(iterator=iterator.value)
+        finally:
+            self.iokit.IOObjectRelease(iterator)
+
+    def read_devices(self, iterator: int) -> dict[str, dict[str, str]]:
+        """
+        Reads all the devices of an IOKit iterator.
+        :param iterator: int. The io_iterator_t to consume.
+        :return: dict[str, dict[str, str]]. The key is the device ID, the value is a dictionary with its properties.
+        """
+        devices = {}
+        device = self.iokit.IOIteratorNext(iterator)
+        while device != 0:
+            try:
+                devices[self.get_device_id(device=device)] = self.__get_properties(device=device)
+            finally:
+                self.iokit.IOObjectRelease(device)
+            device = self.iokit.IOIteratorNext(iterator)
+        return devices
+
+    def create_usb_notifications(self, callback: callable) -> None:
+        """
+        Subscribes to the connection and disconnection of USB devices. The notifications are delivered to the run loop
+        of the calling thread, so this thread must call run_loop() to receive them.
+        :param callback: callable. Function without arguments, called every time a USB device is connected or
+                disconnected.
+        :raises OSError: If the notifications could not be created.
+        """
+        def __on_notification(refcon, iterator):
+            # The iterator must be consumed to re-arm the notification
+            self.release_iterator_objects(iterator=iterator)
+            callback()
+
+        self._notification_port = self.iokit.IONotificationPortCreate(_MACH_PORT_NULL)
+        if self._notification_port is None:
+            raise OSError("IONotificationPortCreate failed")
+        self.cf.CFRunLoopAddSource(self.cf.CFRunLoopGetCurrent(),
+                                   self.iokit.IONotificationPortGetRunLoopSource(self._notification_port),
+                                   self._run_loop_default_mode)
+        self._notification_callback = _IO_SERVICE_MATCHING_CALLBACK(__on_notification)
+        for notification_type in _DARWIN_IOKIT_NOTIFICATION_TYPES:
+            iterator = ctypes.c_uint32()
+            # Each call consumes its own matching dictionary reference
+            matching = self.iokit.IOServiceMatching(_DARWIN_IOKIT_USB_DEVICE_CLASS)
+            result = self.iokit.IOServiceAddMatchingNotification(self._notification_port, notification_type,
+                                                                  matching, self._notification_callback, None,
+                                                                  ctypes.byref(iterator))
+            if result != _KERN_SUCCESS:
+                self.remove_usb_notifications()
+                raise OSError(f"IOServiceAddMatchingNotification failed with error {result}")
+            self._notification_iterators.append(iterator.value)
+            # Devices already connected are returned at registration. Consuming them arms the notification
+            self.release_iterator_objects(iterator=iterator.value)
+
+    def remove_usb_notifications(self) -> None:
+        """
+        Removes the USB notifications created by create_usb_notifications().
+        """
+        for iterator in self._notification_iterators:
+            self.iokit.IOObjectRelease(iterator)
+        if self._notification_port is not None:
+            # Destroying the port also invalidates its run loop source
+            self.iokit.IONotificationPortDestroy(self._notification_port)
+        self._notification_port, self._notification_callback, self._notification_iterators = None, None, []
+
+    def run_loop(self, seconds: int | float) -> None:
+        """
+        Runs the run loop of the current thread, delivering the pending notifications. Returns after handling a
+        notification or after the given number of seconds.
+        :param seconds: int | float. The maximum number of seconds to wait for notifications.
+        """
+        self.cf.CFRunLoopRunInMode(self._run_loop_default_mode, seconds, True)
+
+    def release_iterator_objects(self, iterator: int) -> None:
+        """
+        Consumes an IOKit iterator, releasing all its objects.
+        :param iterator: int. The io_iterator_t to consume.
+        """
+        device = self.iokit.IOIteratorNext(iterator)
+        while device != 0:
+            self.iokit.IOObjectRelease(device)
+            device = self.iokit.IOIteratorNext(iterator)
+
+    def get_device_id(self, device: int) -> str:
+        """
+        Builds the ID of a device in the same format used by ioreg: name@location.
+        :param device: int. The io_registry_entry_t of the device.
+        :return: str. The device ID.
+        """
+        name = ctypes.create_string_buffer(_DARWIN_IOKIT_NAME_LENGTH)
+        self.iokit.IORegistryEntryGetName(device, name)
+        location = ctypes.create_string_buffer(_DARWIN_IOKIT_NAME_LENGTH)
+        if self.iokit.IORegistryEntryGetLocationInPlane(device, _DARWIN_IOKIT_USB_PLANE, location) != _KERN_SUCCESS:
+            return name.value.decode('utf-8', errors='replace')
+        return f"{name.value.decode('utf-8', errors='replace')}@{location.value.decode('utf-8', errors='replace')}"
+
+    def __get_properties(self, device: int) -> dict[str, str]:
+        """
+        Reads the requested properties of a device. Properties that are not strings, numbers or booleans are skipped.
+        :param device: int. The io_registry_entry_t of the device.
+        :return: dict[str, str]. The properties found, converted to strings.
+        """
+        properties = {}
+        for name, key in self._property_keys.items():
+            value = self.iokit.IORegistryEntryCreateCFProperty(device, key, None, 0)
+            if value is None:
+                continue
+            try:
+                string = self.__cf_to_str(cf_value=value)
+            finally:
+                self.cf.CFRelease(value)
+            if string is not None:
+                properties[name] = string
+        return properties
+
+    def __cf_to_str(self, cf_value: int) -> str | None:
+        """
+        Converts a CFString, CFNumber or CFBoolean to a Python string.
+        :param cf_value: int. The CFTypeRef.
+        :return: str | None. The value as a string, or None if its type is not supported.
+        """
+        type_id = self.cf.CFGetTypeID(cf_value)
+        if type_id == self._cf_string_type_id:
+            buffer = ctypes.create_string_buffer(_DARWIN_IOKIT_STRING_LENGTH)
+            if self.cf.CFStringGetCString(cf_value, buffer, _DARWIN_IOKIT_STRING_LENGTH, _CF_STRING_ENCODING_UTF8):
+                return buffer.value.decode('utf-8', errors='replace')
+        elif type_id == self._cf_number_type_id:
+            number = ctypes.c_int64()
+            if self.cf.CFNumberGetValue(cf_value, _CF_NUMBER_SINT64_TYPE, ctypes.byref(number)):
+                return str(number.value)
+        elif type_id == self._cf_boolean_type_id:
+            return "Yes" if self.cf.CFBooleanGetValue(cf_value) else "No"
+        return None
+
+    def __load_library(self, name: str) -> ctypes.CDLL:
+        path = ctypes.util.find_library(name)
+        # find_library returns None if the framework does not exist. Loading None would load the current process
+        if path is None:
+            raise OSError(f"The {name} framework was not found")
+        return ctypes.cdll.LoadLibrary(path)
+
+    def __declare_functions(self) -> None:
+        c_void_p, c_uint32, c_int, c_char_p = ctypes.c_void_p, ctypes.c_uint32, ctypes.c_int, ctypes.c_char_p
+        iokit, cf = self.iokit, self.cf
+        for function, restype, argtypes in (
+                (iokit.IOServiceMatching, c_void_p, [c_char_p]),
+                (iokit.IOServiceGetMatchingServices, c_int, [c_uint32, c_void_p, ctypes.POINTER(c_uint32)]),
+                (iokit.IOIteratorNext, c_uint32, [c_uint32]),
+                (iokit.IOObjectRelease, c_int, [c_uint32]),
+                (iokit.IORegistryEntryGetName, c_int, [c_uint32, c_char_p]),
+                (iokit.IORegistryEntryGetLocationInPlane, c_int, [c_uint32, c_char_p, c_char_p]),
+                (iokit.IORegistryEntryCreateCFProperty, c_void_p, [c_uint32, c_void_p, c_void_p, c_uint32]),
+                (iokit.IONotificationPortCreate, c_void_p, [c_uint32]),
+                (iokit.IONotificationPortGetRunLoopSource, c_void_p, [c_void_p]),
+                (iokit.IONotificationPortDestroy, None, [c_void_p]),
+                (iokit.IOServiceAddMatchingNotification, c_int, [c_void_p, c_char_p, c_void_p,
+                                                                 _IO_SERVICE_MATCHING_CALLBACK, c_void_p,
+                                                                 ctypes.POINTER(c_uint32)]),
+                (cf.CFRunLoopGetCurrent, c_void_p, []),
+                (cf.CFRunLoopAddSource, None, [c_void_p, c_void_p, c_void_p]),
+                (cf.CFRunLoopRunInMode, c_int, [c_void_p, ctypes.c_double, ctypes.c_bool]),
+                (cf.CFStringCreateWithCString, c_void_p, [c_void_p, c_char_p, c_uint32]),
+                (cf.CFStringGetCString, ctypes.c_bool, [c_void_p, c_char_p, ctypes.c_long, c_uint32]),
+                (cf.CFNumberGetValue, ctypes.c_bool, [c_void_p, c_int, c_void_p]),
+                (cf.CFBooleanGetValue, ctypes.c_bool, [c_void_p]),
+                (cf.CFGetTypeID, ctypes.c_ulong, [c_void_p]),
+                (cf.CFStringGetTypeID, ctypes.c_ulong, []),
+                (cf.CFNumberGetTypeID, ctypes.c_ulong, []),
+                (cf.CFBooleanGetTypeID, ctypes.c_ulong, []),
+                (cf.CFRelease, None, [c_void_p])):
+            function.restype, function.argtypes = restype, argtypes
@@ -1,7 +1,8 @@
 """
 _DarwinUSBDetector: This platform-specific implementation of the _USBDetectorBase class is designed for MacOS systems.
 It provides the necessary functionality to detect USB devices connected to a MacOS system and monitor changes in their
-connections. The class utilizes the ioreg command to interact with the MacOS system's device management subsystem.
+connections. The class reads the I/O Registry through IOKit, falling back to the ioreg command if IOKit can not be
+used.
 
 Author: Eric-Canas
 Date: 01-06-2024
@@ -10,17 +11,23 @@ Github: https://github.com/Eric-Canas
 """
 
 from __future__ import annotations
-import re
 import subprocess
 from warnings import warn
 
 from ..attributes import DEVTYPE, ID_VENDOR_ID, DEVNAME, DEVICE_ATTRIBUTES
-from ._constants import _DARWIN_TO_LINUX_ATTRIBUTES, _DARWIN_REGEX_ATTRIBUTES, _SECONDS_BETWEEN_CHECKS
+from ._constants import _LINUX_BY_DARWIN_ATTRIBUTES, _DARWIN_ATTRIBUTES_REGEX, _DARWIN_REGEX_ATTRIBUTES, \
+    _DARWIN_DEVICE_ID_REGEX, _DARWIN_HEX_ATTRIBUTES, _SECONDS_BETWEEN_CHECKS
+from ._darwin_iokit import _IOKit
 from ._usb_detector_base import _USBDetectorBase
 
 
 class _DarwinUSBDetector(_USBDetectorBase):
     def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None):
+        try:
+            self._iokit = _IOKit(property_names=tuple(_LINUX_BY_DARWIN_ATTRIBUTES))
+        except (OSError, AttributeError) as e:
+            warn(f"Could not load IOKit, the ioreg command will be used instead: {e}", RuntimeWarning)
+            self._iokit = None
         super(_DarwinUSBDetector, self).__init__(filter_devices=filter_devices)
 
     def get_available_devices(self) -> dict[str, dict[str, str]]:
@@ -36,53 +43,128 @@ class _DarwinUSBDetector(_USBDetectorBase):
         return devices_info
 
     def _monitor_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None) -> None:
         """
-        Monitors the USB devices. This function should ALWAYS be called from a background thread.
+        Monitors the USB devices. This function should ALWAYS be called from a background thread. Devices are only
+        enumerated again when IOKit notifies that a USB device was connected or disconnected.
         :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
                 arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
         :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
                 two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
-        :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
-                USB devices. Defaults to 0.5 seconds.
+        :param check_every_seconds: int | float. The maximum number of seconds to wait for IOKit notifications before
+                checking if the monitor was stopped. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. The maximum number of seconds to wait between each check
+                when no changes are detected. Only used when falling back to polling.
         """
-        while not self._stop_thread.is_set():
-            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
-            self._stop_thread.wait(check_every_seconds)
+        if self._iokit is not None:
+            iokit_events = []
+            try:
+                self._iokit.create_usb_notifications(callback=lambda: iokit_events.append(True))
+            except OSError as e:
+                warn(f"Could not subscribe to IOKit notifications, falling back to polling: {e}", RuntimeWarning)
+            else:
+                try:
+                    # Catch any change that happened before the notifications were created
+                    self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+                    while not self._stop_thread.is_set():
+                        self._iokit.run_loop(seconds=check_every_seconds)
+                        if len(iokit_events) > 0:
+                            iokit_events.clear()
+                            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+                finally:
+                    self._iokit.remove_usb_notifications()
+                return
+
+        super(_DarwinUSBDetector, self)._monitor_changes(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                         check_every_seconds=check_every_seconds,
+                                                         max_check_every_seconds=max_check_every_seconds)
 
     def __get_usb_devices(self) -> dict[str, dict[str, str]]:
+        """
+        Retrieves the list of USB devices from the I/O Registry. Uses IOKit directly if it is available, and the
+        `ioreg` command otherwise.
+        :return: dict[str, dict[str, str]]. A dictionary of the device information.
+        """
+        if self._iokit is not None:
+            try:
+                return self.__get_usb_devices_from_iokit()
+            except OSError as e:
+                warn(f"Failed to retrieve USB devices from IOKit, using ioreg instead: {e}", RuntimeWarning)
+        return self.__get_usb_devices_from_ioreg()
+
+    def __get_usb_devices_from_iokit(self) -> dict[str, dict[str, str]]:
+        """
+        Retrieves the list of USB devices reading their properties directly through IOKit.
+        :return: dict[str, dict[str, str]]. A dictionary of the device information.
+        """
+        return {device_id: self.__iokit_properties_to_device_info(device_id=device_id, properties=properties)
+                for device_id, properties in self._iokit.get_usb_devices().items()}
+
+    def __iokit_properties_to_device_info(self, device_id: str, properties: dict[str, str]) -> dict[str, str]:
+        """
+        Translates the I/O Registry properties of a device to the Linux attributes.
+        :param device_id: str. The device ID.
+        :param properties: dict[str, str]. The I/O Registry properties of the device.
+        :return: dict[str, str]. The device information.
+        """
+        device_info = {_LINUX_BY_DARWIN_ATTRIBUTES[darwin_attr]: value for darwin_attr, value in properties.items()}
+        for attribute in _DARWIN_HEX_ATTRIBUTES:
+            if attribute in device_info:
+                device_info[attribute] = self.__decimal_id_to_hex(value=device_info[attribute])
+        device_info[DEVNAME] = device_id
+        return device_info
+
+    def __get_usb_devices_from_ioreg(self) -> dict[str, dict[str, str]]:
         """
         Retrieves the list of USB devices using the `ioreg` command.
         :return: dict[str, dict[str, str]]. A dictionary of the device information.
         """
-        try:
-            ioreg_output = subprocess.check_output(['ioreg', '-p', 'IOUSB', '-w0', '-l'], text=True)
-        except subprocess.CalledProcessError as e:
-            warn(f"Failed to retrieve USB devices information: {e}")
+        with subprocess.Popen(['ioreg', '-p', 'IOUSB', '-w0', '-l'], stdout=subprocess.PIPE, text=True) as process:
+            # Parse the lines while ioreg is still writing them, instead of buffering the whole output first
+            devices_info = self.__parse_ioreg_lines(lines=process.stdout)
+        if process.returncode != 0:
+            warn(f"Failed to retrieve USB devices information: "
+                 f"{subprocess.CalledProcessError(returncode=process.returncode, cmd=process.args)}")
             return {}
+        return devices_info
 
+    def __parse_ioreg_lines(self, lines) -> dict[str, dict[str, str]]:
+        """
+        Parses the output of the `ioreg` command.
+        :param lines: Iterable[str]. The lines of the ioreg output.
+        :return: dict[str, dict[str, str]]. A dictionary of the device information.
+        """
         devices_info = {}
         current_device = {}
         device_id = None
 
-        for line in ioreg_output.splitlines():
+        for line in lines:
             if "+-o" in line:
                 if current_device and device_id:
                     devices_info[device_id] = current_device
                 current_device = {}
-                device_id_match = re.search(r"\+-o\s+(.+?)\s+<", line)
+                device_id_match = _DARWIN_DEVICE_ID_REGEX.search(line)
                 if device_id_match:
                     device_id = device_id_match.group(1)
                 else:
                     device_id = None
             else:
-                for attribute, darwin_attr in _DARWIN_TO_LINUX_ATTRIBUTES.items():
-                    if darwin_attr in line:
-                        value = line.split('=')[-1].strip().strip("}").strip('"')
+                # Find every known attribute of the line in a single pass. Most lines do not contain any
+                darwin_attributes = _DARWIN_ATTRIBUTES_REGEX.findall(line)
+                if len(darwin_attributes) == 0:
+                    continue
+                value = line.split('=')[-1].strip().strip("}").strip('"')
+                for darwin_attr in darwin_attributes:
+                    attribute = _LINUX_BY_DARWIN_ATTRIBUTES[darwin_attr]
+                    # ioreg prints the numeric IDs in decimal. They are formatted as in IOKit (and Linux)
+                    if attribute in _DARWIN_HEX_ATTRIBUTES:
+                        current_device[attribute] = self.__decimal_id_to_hex(value=value)
+                    else:
                         current_device[attribute] = value
 
                 for attribute, regex in _DARWIN_REGEX_ATTRIBUTES.items():
-                    match = re.search(regex, line)
+                    match = regex.search(line)
                     if match:
                         current_device[attribute] = match.group(1)
 
@@ -94,3 +176,12 @@ class _DarwinUSBDetector(_USBDetectorBase):
             device_info[DEVNAME] = device_id
 
         return devices_info
+
+    @staticmethod
+    def __decimal_id_to_hex(value: str) -> str:
+        """
+        Formats a numeric ID given in decimal as 4 hex digits, as in Linux. Other values are returned unchanged.
+        :param value: str. The ID, as read from the I/O Registry.
+        :return: str. The ID as 4 hex digits, or the same value if it was not a decimal number.
+        """
+        return f"{int(value):04x}" if value.isdigit() else value
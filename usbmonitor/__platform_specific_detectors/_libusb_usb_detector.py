@@ -0,0 +1,163 @@
+"""
+_LibUSBDetector: This cross-platform implementation of the _USBDetectorBase class is an optional backend that works on
+Windows, Linux and MacOS. It provides the necessary functionality to detect USB devices and monitor changes in their
+connections. The class utilizes the libusb library (through the libusb1 package) to enumerate the devices, and its
+hotplug notifications to be woken up only when a device arrives or leaves.
+"""
+
+from __future__ import annotations
+import threading
+from warnings import warn
+
+from ..attributes import ID_VENDOR_ID, ID_MODEL_ID, ID_VENDOR, ID_MODEL, ID_SERIAL, ID_USB_INTERFACES, DEVNAME, \
+    DEVTYPE, DEVICE_ATTRIBUTES
+from ._constants import _SECONDS_BETWEEN_CHECKS, _LIBUSB_DEVICE_ID_FORMAT, _THREAD_JOIN_TIMEOUT_SECONDS
+from ._usb_detector_base import _USBDetectorBase
+
+
+class _LibUSBDetector(_USBDetectorBase):
+    def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None):
+        import usb1
+        self._context = usb1.USBContext().open()
+        # Device information of the last enumeration, keyed by device ID: ((vendor_id, product_id), device_info)
+        self._device_info_cache = {}
+        # Handle of the hotplug callback while monitoring. Deregistered by whichever thread stops it first
+        self._hotplug_handle, self._hotplug_lock = None, threading.Lock()
+        try:
+            super(_LibUSBDetector, self).__init__(filter_devices=filter_devices)
+        except Exception:
+            self.__close_context()
+            raise
+
+    def get_available_devices(self) -> dict[str, dict[str, str | tuple[str, ...]]]:
+        """
+        Returns a dictionary of the currently available devices, where the key is the device ID and the value is a
+        dictionary of the device's information.
+        :return: dict[str, dict[str, str | tuple[str, ...]]]. The key is the device ID, the value is a dictionary of
+                the device's information.
+        """
+        devices_info, device_info_cache = {}, {}
+        for device in self._context.getDeviceList(skip_on_error=True):
+            device_id = _LIBUSB_DEVICE_ID_FORMAT.format(bus=device.getBusNumber(), address=device.getDeviceAddress())
+            fingerprint = (device.getVendorID(), device.getProductID())
+            # Reading the string descriptors requires opening the device, so reuse them while it stays connected
+            cached_fingerprint, device_info = self._device_info_cache.get(device_id, (None, None))
+            if cached_fingerprint != fingerprint:
+                device_info = self.__get_device_info(device=device, device_id=device_id)
+            device_info_cache[device_id] = (fingerprint, device_info)
+            devices_info[device_id] = device_info
+        # Only keep the devices that are still connected
+        self._device_info_cache = device_info_cache
+
+        if self.filter_devices is not None:
+            devices_info = self._apply_devices_filter(devices=devices_info)
+        return devices_info
+
+    def _monitor_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None) -> None:
+        """
+        Monitors the USB devices. This function should ALWAYS be called from a background thread.
+        :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
+                arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
+        :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
+                two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
+        :param check_every_seconds: int | float. The maximum number of seconds to wait for libusb events before
+                checking if the monitor was stopped. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. The maximum number of seconds to wait between each check
+                when no changes are detected. Only used when falling back to polling.
+        """
+        import usb1
+        if not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            warn("The libusb library does not support hotplug notifications on this system, falling back to polling",
+                 RuntimeWarning)
+            super(_LibUSBDetector, self)._monitor_changes(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                          check_every_seconds=check_every_seconds,
+                                                          max_check_every_seconds=max_check_every_seconds)
+            return
+
+        hotplug_events = []
+
+        def __handle_hotplug_event(context, device, event):
+            # No synchronous libusb function can be called from here, so just take note and check the changes later
+            hotplug_events.append(event)
+            # Keep the callback registered
+            return False
+
+        with self._hotplug_lock:
+            self._hotplug_handle = self._context.hotplugRegisterCallback(__handle_hotplug_event, flags=0)
+        try:
+            # Catch any change that happened before the callback was registered
+            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+            while not self._stop_thread.is_set():
+                self._context.handleEventsTimeout(tv=check_every_seconds)
+                if len(hotplug_events) > 0:
+                    hotplug_events.clear()
+                    self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+        finally:
+            self.__deregister_hotplug_callback()
+
+    def stop_monitoring(self, warn_if_was_stopped: bool = True, warn_if_timeout: bool = True,
+                        timeout=_THREAD_JOIN_TIMEOUT_SECONDS) -> None:
+        """
+        Stops monitoring the USB devices, deregistering the hotplug callback even if the monitor thread does not
+        stop in time. See _USBDetectorBase.stop_monitoring.
+        """
+        if self._thread is not None:
+            self._stop_thread.set()
+            self.__deregister_hotplug_callback()
+        super(_LibUSBDetector, self).stop_monitoring(warn_if_was_stopped=warn_if_was_stopped,
+                                                     warn_if_timeout=warn_if_timeout, timeout=timeout)
+
+    def __del__(self):
+        super(_LibUSBDetector, self).__del__()
+        self.__close_context()
+
+    def __deregister_hotplug_callback(self) -> None:
+        """
+        Deregisters the hotplug callback, if it is still registered.
+        """
+        with self._hotplug_lock:
+            if self._hotplug_handle is not None:
+                self._context.hotplugDeregisterCallback(self._hotplug_handle)
+                self._hotplug_handle = None
+
+    def __close_context(self) -> None:
+        """
+        Closes the libusb context, if it is still open. The detector can not be used after it.
+        """
+        if getattr(self, '_context', None) is not None:
+            self._context.close()
+            self._context = None
+
+    def __get_device_info(self, device, device_id: str) -> dict[str, str | tuple[str, ...]]:
+        """
+        Builds the device information dictionary of a libusb device, using the same keys as Linux.
+        :param device: usb1.USBDevice. The libusb device.
+        :param device_id: str. The device ID.
+        :return: dict[str, str | tuple[str, ...]]. The device information.
+        """
+        import usb1
+        device_info = {attr: "" for attr in DEVICE_ATTRIBUTES}
+        device_info.update({ID_VENDOR_ID: f"{device.getVendorID():04x}", ID_MODEL_ID: f"{device.getProductID():04x}",
+                            DEVNAME: device_id, DEVTYPE: 'usb_device'})
+        try:
+            device_info[ID_USB_INTERFACES] = tuple(f"{setting.getClass():02x}{setting.getSubClass():02x}"
+                                                   f"{setting.getProtocol():02x}" for setting in device.iterSettings())
+        except usb1.USBError:
+            device_info[ID_USB_INTERFACES] = ()
+        # String descriptors can only be read if the user has permissions to open the device
+        try:
+            handle = device.open()
+        except usb1.USBError:
+            return device_info
+        try:
+            for attribute, get_string in ((ID_VENDOR, handle.getManufacturer), (ID_MODEL, handle.getProduct),
+                                          (ID_SERIAL, handle.getSerialNumber)):
+                try:
+                    device_info[attribute] = get_string() or ""
+                except usb1.USBError:
+                    pass
+        finally:
+            handle.close()
+        return device_info
@@ -11,20 +11,77 @@ Github: https://github.com/Eric-Canas
 """
 
 from __future__ import annotations
+import errno
+import os
+import selectors
+import threading
+import weakref
+from functools import partial
+from warnings import warn
 
-from ._constants import _SECONDS_BETWEEN_CHECKS, _LINUX_TUPLE_ATTRIBUTES_SEPARATORS
+# The package imports this module on every OS, but pyudev is only installed (and this detector only used) on Linux
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+from ._constants import _SECONDS_BETWEEN_CHECKS, _THREAD_JOIN_TIMEOUT_SECONDS, \
+    _LINUX_TUPLE_ATTRIBUTES_SEPARATORS_ITEMS, _LINUX_DEVICE_FINGERPRINT_ATTRIBUTES
 from ..attributes import ID_VENDOR_ID, DEVTYPE, DEVICE_ATTRIBUTES, DEVNAME
 
 from ._usb_detector_base import _USBDetectorBase
 
 
 class _LinuxUSBDetector(_USBDetectorBase):
-    def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None):
-        import pyudev
+    # Netlink monitors are shared by all the detectors of the same subsystem, so monitoring from several instances
+    # does not open a socket and receive every event once per instance. Every event is delivered to all the subscribed
+    # detectors by the monitor thread that reads it. {subsystem: pyudev.Monitor} and {subsystem: WeakSet of detectors}
+    _shared_monitors, _shared_subscribers = {}, {}
+    _shared_lock = threading.Lock()
+    # Only one monitor thread reads and delivers events at a time, so they are handled in order
+    _dispatch_lock = threading.Lock()
+
+    def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None,
+                 subsystem: str = 'usb'):
+        """
+        :param filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None. See _USBDetectorBase.
+        :param subsystem: str. The udev subsystem of the devices to list and monitor. With 'usb', only the
+                'usb_device' nodes are considered. Any other subsystem (e.g. 'tty') will consider the nodes of that
+                subsystem that belong to a USB device, so they are only notified once they are ready to be used.
+        :raises ImportError: If pyudev is not installed.
+        """
+        if pyudev is None:
+            raise ImportError("The Linux USB detector requires the pyudev package. Install it with: pip install pyudev")
         self.context = pyudev.Context()
-        self.monitor = None
+        self.subsystem = subsystem
+        # Netlink monitor delivering the udev events of the subsystem. None if netlink is not available
+        self.monitor = self.__get_shared_monitor()
+        # Write end of the pipe that wakes the monitor thread up when stop_monitoring() is called. The lock prevents
+        # writing to it while it is being closed
+        self._wake_up_fd, self._wake_up_lock = None, threading.Lock()
+        # Callbacks of the running monitor, used by the udev events handler
+        self._on_connect, self._on_disconnect = None, None
+        # Device information of the last enumeration, keyed by device ID: (fingerprint, device_info)
+        self._device_info_cache = {}
         super(_LinuxUSBDetector, self).__init__(filter_devices=filter_devices)
 
+    def __get_shared_monitor(self):
+        """
+        Returns the netlink monitor of self.subsystem, shared by all the detectors. Creates it if it does not exist.
+        :return: pyudev.Monitor | None. The monitor, or None if netlink is not available.
+        """
+        with _LinuxUSBDetector._shared_lock:
+            if self.subsystem not in _LinuxUSBDetector._shared_monitors:
+                try:
+                    monitor = pyudev.Monitor.from_netlink(self.context)
+                    monitor.filter_by(subsystem=self.subsystem)
+                except OSError as e:
+                    warn(f"Could not create the udev netlink monitor, changes will be detected by polling: {e}",
+                         RuntimeWarning)
+                    return None
+                _LinuxUSBDetector._shared_monitors[self.subsystem] = monitor
+            return _LinuxUSBDetector._shared_monitors[self.subsystem]
+
     def get_available_devices(self) -> dict[str, dict[str, str | tuple[str, ...]]]:
         """
         Returns a dictionary of the currently available devices, where the key is the device ID and the value is a
@@ -32,19 +89,42 @@ class _LinuxUSBDetector(_USBDetectorBase):
         :return: dict[str, dict[str, str]]. The key is the device ID, the value is a dictionary of the device's
                 information.
         """
-        usb_devices = [device for device in self.context.list_devices(subsystem='usb') if ID_VENDOR_ID in device]
-        devices_info = {}
+        # Let libudev match the ID_VENDOR_ID property (fnmatch pattern), instead of filtering every node in Python
+        usb_devices = self.context.list_devices(subsystem=self.subsystem).match_property(ID_VENDOR_ID, '*')
+        devices_info, device_info_cache = {}, {}
         for device in usb_devices:
-            device_id = device[DEVNAME]
-            device_info = {attr: device.get(attr, "") for attr in DEVICE_ATTRIBUTES}
-            device_info = self.__generate_tuple_attributes_from_string(device_info=device_info)
-            devices_info[device_id] = device_info
+            # Read from the properties mapping directly. device.get() goes through the deprecated Device.__getitem__,
+            # that emits a DeprecationWarning and builds a new Properties mapping for every single attribute
+            properties = device.properties
+            device_id = properties.get(DEVNAME)
+            # Nodes without a device node (e.g. 'net' interfaces or 'sound' cards) can not be identified by it
+            if device_id is None:
+                continue
+            device_info_cache[device_id] = self.__get_device_info(device_id=device_id, properties=properties)
+            devices_info[device_id] = device_info_cache[device_id][1]
+        # Only keep the devices that are still connected
+        self._device_info_cache = device_info_cache
 
         if self.filter_devices is not None:
             devices_info = self._apply_devices_filter(devices=devices_info)
 
         return devices_info
 
+    def __get_device_info(self, device_id: str, properties) -> tuple[tuple[str, ...], dict[str, str | tuple[str, ...]]]:
+        """
+        Returns the information of a device. It reuses the cached one if the device behind this ID is still the same.
+        :param device_id: str. The device ID.
+        :param properties: pyudev.Properties. The udev properties of the device.
+        :return: tuple[tuple[str, ...], dict[str, str | tuple[str, ...]]]. The fingerprint of the device and its
+                information, as stored in the cache.
+        """
+        fingerprint = tuple(properties.get(attr, "") for attr in _LINUX_DEVICE_FINGERPRINT_ATTRIBUTES)
+        cached_fingerprint, device_info = self._device_info_cache.get(device_id, (None, None))
+        if cached_fingerprint != fingerprint:
+            device_info = {attr: properties.get(attr, "") for attr in DEVICE_ATTRIBUTES}
+            device_info = self.__generate_tuple_attributes_from_string(device_info=device_info)
+        return fingerprint, device_info
+
     def __generate_tuple_attributes_from_string(self, device_info: dict[str, str]) -> dict[str, tuple[str]|str]:
         """
         Generates a tuple of attributes for those attributes that are expected to be a tuple,
@@ -52,43 +132,277 @@ class _LinuxUSBDetector(_USBDetectorBase):
         :param device_info: dict[str, str]. The device information.
         :return: dict[str, tuple[str]|str]. The device information with the tuple attributes.
         """
-        for attribute, separator in _LINUX_TUPLE_ATTRIBUTES_SEPARATORS.items():
+        # Values always come from udev properties (or the "" default), so they are known to be strings
+        for attribute, separator in _LINUX_TUPLE_ATTRIBUTES_SEPARATORS_ITEMS:
             if attribute in device_info:
-                assert isinstance(device_info[attribute], str), f"The attribute '{attribute}' is expected to be a string"
                 # noinspection PyTypeChecker
                 device_info[attribute] = tuple(value for value in device_info[attribute].split(separator) if value != "")
         return device_info
 
     def _monitor_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
-        import pyudev
-
-        def __handle_device_event(device):
-            action = device.action
-            if device.get(DEVTYPE) == 'usb_device':
-                device_id = device[DEVNAME]
-                if action == "add" and on_connect is not None:
-                    device_info = {attr: device.get(attr, "") for attr in DEVICE_ATTRIBUTES}
-                    device_info = self.__generate_tuple_attributes_from_string(device_info=device_info)
-                    on_connect(device_id, device_info)
-                    self.last_check_devices = self.get_available_devices()
-                elif action == "remove" and on_disconnect is not None and device_id in self.last_check_devices:
-                    device_info = self.last_check_devices[device_id].copy()
-                    on_disconnect(device_id, device_info)
-                    self.last_check_devices = self.get_available_devices()
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None) -> None:
+        """
+        Monitors the USB devices. This function should ALWAYS be called from a background thread. Changes are
+        delivered by the udev netlink events, so devices are never re-enumerated while monitoring.
+        :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
+                arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
+        :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
+                two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
+        :param check_every_seconds: int | float. Only used when falling back to polling. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. Only used when falling back to polling.
+        """
+        if self.monitor is None:
+            super(_LinuxUSBDetector, self)._monitor_changes(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                           check_every_seconds=check_every_seconds,
+                                                           max_check_every_seconds=max_check_every_seconds)
+            return
+        self._on_connect, self._on_disconnect = on_connect, on_disconnect
+        subscribers = self.__subscribe()
+        wake_up_read_fd, self._wake_up_fd = os.pipe()
+        try:
+            with selectors.DefaultSelector() as selector:
+                # Wait on the netlink socket directly from this thread, instead of running a MonitorObserver thread
+                self.monitor.start()
+                selector.register(self.monitor.fileno(), selectors.EVENT_READ)
+                selector.register(wake_up_read_fd, selectors.EVENT_READ)
+                # Catch any change that happened before subscribing
+                self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+
+                # Block until there are udev events or stop_monitoring() is called. No need to wake up periodically
+                while not self._stop_thread.is_set():
+                    for key, _ in selector.select():
+                        if key.fd == wake_up_read_fd:
+                            os.read(wake_up_read_fd, 1)
+                    # Other monitor threads can be woken up by the same events. The first one delivers them to everyone
+                    with _LinuxUSBDetector._dispatch_lock:
+                        # Read the whole burst (e.g. a hub being plugged) before handling any of its events
+                        try:
+                            devices = list(iter(partial(self.monitor.poll, timeout=0), None))
+                        except OSError as e:
+                            # Events were lost (e.g. ENOBUFS during an event storm). Enumerate again for everyone
+                            warn(f"Failed to read udev events, checking all the devices again: {e}", RuntimeWarning)
+                            self.__resync_subscribers(subscribers=subscribers)
+                            # Do not spin if the error persists
+                            if e.errno != errno.ENOBUFS:
+                                self._stop_thread.wait(check_every_seconds)
+                            continue
+                        for device in self.__coalesce_device_events(devices=devices):
+                            self.__dispatch_device_event(device=device, subscribers=subscribers)
+        finally:
+            with self._wake_up_lock:
+                os.close(self._wake_up_fd)
+                self._wake_up_fd = None
+            os.close(wake_up_read_fd)
+            self.__unsubscribe()
+            self._on_connect, self._on_disconnect = None, None
 
+    def stop_monitoring(self, warn_if_was_stopped: bool = True, warn_if_timeout: bool = True,
+                        timeout=_THREAD_JOIN_TIMEOUT_SECONDS) -> None:
+        """
+        Stops monitoring the USB devices, waking up the monitor thread if it is waiting for udev events.
+        See _USBDetectorBase.stop_monitoring.
+        """
+        if self._thread is not None:
+            # The event must be set before waking the thread up, so it does not go back to wait
+            self._stop_thread.set()
+            with self._wake_up_lock:
+                if self._wake_up_fd is not None:
+                    os.write(self._wake_up_fd, b'\0')
+        super(_LinuxUSBDetector, self).stop_monitoring(warn_if_was_stopped=warn_if_was_stopped,
+                                                       warn_if_timeout=warn_if_timeout, timeout=timeout)
+
+    async def monitor_changes_async(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                                    check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+        """
+        Monitors the USB devices from the running asyncio event loop, without starting any monitor thread. The udev
+        events are read when the event loop reports that the netlink socket is readable. It runs until the task is
+        cancelled.
+        :param on_connect: callable | None. See _USBDetectorBase.monitor_changes_async.
+        :param on_disconnect: callable | None. See _USBDetectorBase.monitor_changes_async.
+        :param check_every_seconds: int | float. Only used when falling back to polling.
+        """
+        import asyncio
         if self.monitor is None:
-            self.monitor = pyudev.Monitor.from_netlink(self.context)
-            self.monitor.filter_by(subsystem='usb')
+            await super(_LinuxUSBDetector, self).monitor_changes_async(on_connect=on_connect,
+                                                                       on_disconnect=on_disconnect,
+                                                                       check_every_seconds=check_every_seconds)
+            return
+        assert self._thread is None, "The USB monitor is already running in a background thread"
+        # Own monitor, as the shared one could be read at the same time by the monitor thread of another detector
+        monitor = pyudev.Monitor.from_netlink(self.context)
+        monitor.filter_by(subsystem=self.subsystem)
+        monitor.start()
+        loop = asyncio.get_running_loop()
+        self._on_connect, self._on_disconnect = on_connect, on_disconnect
+        loop.add_reader(monitor.fileno(), self.__read_monitor_events, monitor)
+        try:
+            # Catch any change that happened before starting the monitor
+            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+            # Events are handled by the reader callback. Just wait until cancelled
+            await loop.create_future()
+        finally:
+            loop.remove_reader(monitor.fileno())
+            self._on_connect, self._on_disconnect = None, None
+            # pyudev monitors can not be stopped explicitly. Releasing the last reference closes its netlink socket,
+            # so the kernel stops queueing events into it
+            del monitor
 
-        self._thread = pyudev.MonitorObserver(self.monitor, name="USB Monitor", callback=__handle_device_event)
+    def __read_monitor_events(self, monitor) -> None:
+        """
+        Handles all the udev events that are ready to be read from the monitor, without blocking.
+        :param monitor: pyudev.Monitor. The monitor whose socket is readable.
+        """
+        try:
+            devices = list(iter(partial(monitor.poll, timeout=0), None))
+        except OSError as e:
+            # Events were lost (e.g. ENOBUFS during an event storm). Enumerate the devices again
+            warn(f"Failed to read udev events, checking all the devices again: {e}", RuntimeWarning)
+            self.check_changes(on_connect=self._on_connect, on_disconnect=self._on_disconnect)
+            return
+        for device in self.__coalesce_device_events(devices=devices):
+            try:
+                self.__handle_device_event(device)
+            except Exception as e:
+                warn(f"USB monitor failed to handle a udev event: {e!r}", RuntimeWarning)
+
+    def __subscribe(self) -> weakref.WeakSet:
+        """
+        Subscribes this detector to the udev events of self.subsystem, read by any of the running monitor threads.
+        :return: weakref.WeakSet. The detectors subscribed to the events of self.subsystem.
+        """
+        with _LinuxUSBDetector._shared_lock:
+            # Weak references, so subscribed detectors can still be garbage collected
+            subscribers = _LinuxUSBDetector._shared_subscribers.setdefault(self.subsystem, weakref.WeakSet())
+            if len(subscribers) == 0:
+                # Nobody was reading the shared monitor, but the kernel kept queueing the events into its socket. They
+                # are stale, the initial check_changes of the subscriber already covers them
+                self.__drain_monitor()
+            subscribers.add(self)
+        return subscribers
+
+    def __drain_monitor(self) -> None:
+        """
+        Discards all the udev events queued in the monitor, without blocking.
+        """
+        while True:
+            try:
+                if self.monitor.poll(timeout=0) is None:
+                    return
+            except OSError as e:
+                # ENOBUFS only reports that the socket buffer overflowed. The events still queued can be read
+                if e.errno != errno.ENOBUFS:
+                    return
+
+    def __unsubscribe(self) -> None:
+        """
+        Unsubscribes this detector from the udev events of self.subsystem.
+        """
+        with _LinuxUSBDetector._shared_lock:
+            subscribers = _LinuxUSBDetector._shared_subscribers[self.subsystem]
+            subscribers.discard(self)
+            if len(subscribers) == 0:
+                del _LinuxUSBDetector._shared_subscribers[self.subsystem]
 
-        # Start the observer thread
-        self._thread.start()
+    @staticmethod
+    def __resync_subscribers(subscribers: weakref.WeakSet) -> None:
+        """
+        Makes every subscribed detector check its devices again, notifying the changes missed by the lost events.
+        :param subscribers: weakref.WeakSet. The detectors subscribed to the events of the monitor.
+        """
+        for detector in tuple(subscribers):
+            try:
+                detector.check_changes(on_connect=detector._on_connect, on_disconnect=detector._on_disconnect)
+            except Exception as e:
+                warn(f"USB monitor failed to check the devices again: {e!r}", RuntimeWarning)
+
+    @staticmethod
+    def __coalesce_device_events(devices: list) -> list:
+        """
+        Drops the udev events that would not change the final state: 'change' events followed by any other event of
+        the same device, and events repeating the previous action of the same device. Additions and removals are
+        never collapsed, so every connection and disconnection is still notified.
+        :param devices: list[pyudev.Device]. The devices of the events, in the order they were received.
+        :return: list[pyudev.Device]. The devices of the events to handle, in the same order.
+        """
+        if len(devices) <= 1:
+            return devices
+        # Index in coalesced of the last 'change' event and of the last other event of each device path
+        coalesced, change_index, last_action_index = [], {}, {}
+        for device in devices:
+            device_path, action = device.device_path, device.action
+            if device_path in change_index:
+                coalesced[change_index.pop(device_path)] = None
+            if action == 'change':
+                change_index[device_path] = len(coalesced)
+            else:
+                previous_index = last_action_index.get(device_path)
+                if previous_index is not None and coalesced[previous_index].action == action:
+                    continue
+                last_action_index[device_path] = len(coalesced)
+            coalesced.append(device)
+        return [device for device in coalesced if device is not None]
 
-        # Keep the main thread alive, checking for changes every specified interval
-        while not self._stop_thread.is_set():
-            self._stop_thread.wait(check_every_seconds)
+    @staticmethod
+    def __dispatch_device_event(device, subscribers: weakref.WeakSet) -> None:
+        """
+        Delivers a udev event read from a shared monitor to all its subscribed detectors.
+        :param device: pyudev.Device. The device that caused the event.
+        :param subscribers: weakref.WeakSet. The detectors subscribed to the events of the monitor.
+        """
+        for detector in tuple(subscribers):
+            # An exception would kill the monitor thread, and with it the monitoring of every other detector
+            try:
+                detector.__handle_device_event(device)
+            except Exception as e:
+                warn(f"USB monitor failed to handle a udev event: {e!r}", RuntimeWarning)
 
-        # Stop the observer thread
-        self._thread.stop()
\ No newline at end of file
+    def __handle_device_event(self, device) -> None:
+        """
+        Handles a udev event read from the monitor. Updates the last checked devices with the information in the
+        event itself (without enumerating the devices again) and calls the corresponding callback. 'change' events
+        only refresh the information of the device.
+        :param device: pyudev.Device. The device that caused the event.
+        """
+        action, properties = device.action, device.properties
+        if action not in ('add', 'remove', 'change') or ID_VENDOR_ID not in properties:
+            return
+        if self.subsystem == 'usb' and properties.get(DEVTYPE) != 'usb_device':
+            return
+        device_id = properties.get(DEVNAME)
+        if device_id is None:
+            return
+        # last_check_devices is replaced instead of modified, as other threads could be iterating over it
+        if action == "add" and device_id not in self.last_check_devices:
+            self._device_info_cache[device_id] = self.__get_device_info(device_id=device_id, properties=properties)
+            device_info = self._device_info_cache[device_id][1]
+            if self.filter_devices is not None and \
+                    len(self._apply_devices_filter(devices={device_id: device_info})) == 0:
+                return
+            self.last_check_devices = {**self.last_check_devices, device_id: device_info}
+            if self._on_connect is not None:
+                self._on_connect(device_id, device_info)
+        elif action == "remove" and device_id in self.last_check_devices:
+            self._device_info_cache.pop(device_id, None)
+            last_check_devices = self.last_check_devices.copy()
+            device_info = last_check_devices.pop(device_id)
+            self.last_check_devices = last_check_devices
+            if self._on_disconnect is not None:
+                self._on_disconnect(device_id, device_info)
+        elif action == "change":
+            # Some properties can change without changing the fingerprint (e.g. the ones read from the hwdb)
+            self._device_info_cache.pop(device_id, None)
+            self._device_info_cache[device_id] = self.__get_device_info(device_id=device_id, properties=properties)
+            device_info = self._device_info_cache[device_id][1]
+            # The new information can make the device start or stop matching the filter
+            if self.filter_devices is None or len(self._apply_devices_filter(devices={device_id: device_info})) > 0:
+                was_connected = device_id in self.last_check_devices
+                self.last_check_devices = {**self.last_check_devices, device_id: device_info}
+                if not was_connected and self._on_connect is not None:
+                    self._on_connect(device_id, device_info)
+            elif device_id in self.last_check_devices:
+                last_check_devices = self.last_check_devices.copy()
+                device_info = last_check_devices.pop(device_id)
+                self.last_check_devices = last_check_devices
+                if self._on_disconnect is not None:
+                    self._on_disconnect(device_id, device_info)
@@ -12,11 +12,17 @@ Github: https://github.com/Eric-Canas
 """
 from __future__ import annotations
 
+import os
+import queue
+import sys
 import threading
+import time
 from warnings import warn
 from abc import ABC, abstractmethod
 
-from ._constants import _SECONDS_BETWEEN_CHECKS, _THREAD_JOIN_TIMEOUT_SECONDS
+from ._constants import _SECONDS_BETWEEN_CHECKS, _THREAD_JOIN_TIMEOUT_SECONDS, _IDLE_BACKOFF_FACTOR, \
+    _CALLBACKS_QUEUE_MAX_SIZE, _LINUX_MONITOR_RR_PRIORITY, _LINUX_MONITOR_NICE_INCREMENT, \
+    _WINDOWS_THREAD_PRIORITY_ABOVE_NORMAL, _MAX_CHECKS_DELAY_SECONDS, _CONNECT_EVENT, _DISCONNECT_EVENT
 
 
 class _USBDetectorBase(ABC):
@@ -31,6 +37,10 @@ class _USBDetectorBase(ABC):
         filter_devices=({"ID_MODEL_ID": "A2B2"}, {"ID_MODEL_ID": "ABCD"}).
         """
         self._thread = None
+        # Callbacks triggered while monitoring are executed by this thread, so they never delay the monitor thread
+        self._callbacks_thread, self._callbacks_queue = None, None
+        # Executor where monitor_changes_async enumerates the devices. None means the default executor of the loop
+        self._async_executor = None
         self.filter_devices = filter_devices
         self._stop_thread = threading.Event()
 
@@ -40,8 +50,9 @@ class _USBDetectorBase(ABC):
             assert all(isinstance(device, dict) for device in filter_devices), f"filter_devices must contain dicts. " \
                                                                 f"Got {set(type(device) for device in filter_devices)}"
 
+        # last_check_devices is always replaced, never modified in place, so both can share the same dict
         self.on_start_devices = self.get_available_devices()
-        self.last_check_devices = self.on_start_devices.copy()
+        self.last_check_devices = self.on_start_devices
 
     def changes_from_last_check(self, update_last_check_devices: bool = True) -> tuple[dict[str, str], dict[str, str]]:
         """
@@ -52,12 +63,21 @@ class _USBDetectorBase(ABC):
                 were removed, the second tuple contains the information of the new devices that were added.
         """
         current_devices, prev_devices = self.get_available_devices(), self.last_check_devices
-        # Get the difference between the current devices and the previous ones
-        removed_devices = {_id: _info for _id, _info in prev_devices.items() if _id not in current_devices}
-        added_devices = {_id: _info for _id, _info in current_devices.items() if _id not in prev_devices}
-        # Update the last checked devices to the current devices if requested
+        # Most of the checks find the same devices. Comparing the keys views is done in C and does not build any set
+        if current_devices.keys() == prev_devices.keys():
+            if update_last_check_devices:
+                self.last_check_devices = current_devices
+            return {}, {}
+        # Get the difference between the current devices and the previous ones (set operations over the keys views).
+        # The dicts are iterated instead of the sets, so the devices keep the order in which they were enumerated
+        removed_ids = prev_devices.keys() - current_devices.keys()
+        added_ids = current_devices.keys() - prev_devices.keys()
+        removed_devices = {_id: info for _id, info in prev_devices.items() if _id in removed_ids}
+        added_devices = {_id: info for _id, info in current_devices.items() if _id in added_ids}
+        # Update the last checked devices to the current devices if requested. get_available_devices() always
+        # returns a new dict, so there is no need to copy it
         if update_last_check_devices:
-            self.last_check_devices = current_devices.copy()
+            self.last_check_devices = current_devices
         return removed_devices, added_devices
 
     @abstractmethod
@@ -79,18 +99,14 @@ class _USBDetectorBase(ABC):
                 `get_available_devices` method.
         :return: dict[str, dict[str, str|tuple[str, ...]]]. The input devices that matches any of the given filters
         """
-        # Copy the dict to avoid allow iteration while modifying the original dict
-        for device_id, device_info in devices.copy().items():
-            # Iterate over each filter dict
-            for filter_dict in self.filter_devices:
-                if all(device_info[key] == value for key, value in filter_dict.items()):
-                    break
-            else:
-                devices.pop(device_id)
-        return devices
+        # A device matches a filter if the filter items are a subset of its items. Comparing the items views is done in
+        # C, without hashing the values (so they can be unhashable) nor building any intermediate set
+        filters_items = tuple(filter_dict.items() for filter_dict in self.filter_devices)
+        return {device_id: device_info for device_id, device_info in devices.items()
+                if any(filter_items <= device_info.items() for filter_items in filters_items)}
 
     def check_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                      update_last_check_devices: bool = True) -> None:
+                      update_last_check_devices: bool = True) -> tuple[dict[str, str], dict[str, str]]:
         """
         Checks for changes in the USB devices. If a device is removed, the `on_disconnect` function will be called
         with the device ID as the first argument and the device information as the second argument. If a device is
@@ -100,8 +116,24 @@ class _USBDetectorBase(ABC):
         :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to
                 receive two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
         :param update_last_check_devices: bool. Whether to update the last checked devices to the current devices
+        :return: tuple[dict[str, str], dict[str, str]]. The removed and the added devices, as returned by
+                `changes_from_last_check`.
         """
         removed_devices, added_devices = self.changes_from_last_check(update_last_check_devices=update_last_check_devices)
+        self.__notify_changes(removed_devices=removed_devices, added_devices=added_devices,
+                              on_connect=on_connect, on_disconnect=on_disconnect)
+        return removed_devices, added_devices
+
+    def __notify_changes(self, removed_devices: dict[str, dict[str, str | tuple[str, ...]]],
+                         added_devices: dict[str, dict[str, str | tuple[str, ...]]],
+                         on_connect: callable | None = None, on_disconnect: callable | None = None) -> None:
+        """
+        Calls the `on_disconnect` function for each removed device and the `on_connect` function for each added one.
+        :param removed_devices: dict[str, dict[str, str|tuple[str, ...]]]. The removed devices.
+        :param added_devices: dict[str, dict[str, str|tuple[str, ...]]]. The added devices.
+        :param on_connect: callable | None. The function to call when a device is added.
+        :param on_disconnect: callable | None. The function to call when a device is removed.
+        """
         if on_disconnect is not None:
             for device_id, device_info in removed_devices.items():
                 on_disconnect(device_id, device_info)
@@ -109,13 +141,40 @@ class _USBDetectorBase(ABC):
             for device_id, device_info in added_devices.items():
                 on_connect(device_id, device_info)
 
+    async def monitor_changes_async(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                                    check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+        """
+        Monitors the USB devices from the running asyncio event loop, without starting any monitor thread. The
+        callbacks are called from the event loop, so they must not block it. It runs until the task is cancelled.
+        :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
+                arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
+        :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
+                two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
+        :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
+                USB devices. Defaults to 0.5 seconds.
+        """
+        import asyncio
+        assert self._thread is None, "The USB monitor is already running in a background thread"
+        loop = asyncio.get_running_loop()
+        while True:
+            # Enumerating the devices blocks, so it is done in an executor to keep the event loop responsive
+            removed_devices, added_devices = await loop.run_in_executor(self._async_executor,
+                                                                        self.changes_from_last_check)
+            self.__notify_changes(removed_devices=removed_devices, added_devices=added_devices,
+                                  on_connect=on_connect, on_disconnect=on_disconnect)
+            await asyncio.sleep(check_every_seconds)
+
     def start_monitoring(self, on_connect: callable|None = None, on_disconnect: callable|None = None,
-                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None, raise_priority: bool = False,
+                         on_connect_batch: callable | None = None, on_disconnect_batch: callable | None = None,
+                         batch_window_seconds: int | float = 0.) -> None:
         """
         Starts monitoring the USB devices. This function will trigger a background thread that will check for changes
         in the USB devices every `check_every_seconds` seconds. If a device is removed, the `on_disconnect` function
         will be called with the device ID as the first argument and the device information as the second argument.
-        If a device is added, the `on_connect` function with the same arguments.
+        If a device is added, the `on_connect` function with the same arguments. Callbacks are executed by their own
+        background thread, so a slow callback does not delay the detection of the next changes.
         :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
                 arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
         :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
@@ -123,15 +182,155 @@ class _USBDetectorBase(ABC):
 
         :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
                 USB devices. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. If given, the time between checks will progressively grow
+                up to this value while no changes are detected, and will go back to `check_every_seconds` as soon as
+                a change is found. It reduces the load on idle systems at the cost of a higher detection latency.
+                Only used by the detectors that poll for changes. Defaults to None (fixed interval).
+        :param raise_priority: bool. Whether to raise the scheduling priority of the monitor thread, so USB changes are
+                detected without delay even when the CPU is busy. On Linux it requires the CAP_SYS_NICE capability
+                (it warns if it can not be raised). Defaults to False.
+        :param on_connect_batch: callable | None. The function to call with all the devices added within the same
+                batch window. It is expected to receive a single argument, a dictionary with the device IDs as keys
+                and the device information as values. on_connect_batch(devices: dict[str, dict[str, str]])
+        :param on_disconnect_batch: callable | None. The same as `on_connect_batch`, for the removed devices.
+        :param batch_window_seconds: int | float. The number of seconds to keep collecting changes for the batch
+                callbacks after the first one arrives. With 0, only the changes detected together (e.g. in the same
+                check) are batched. Defaults to 0.
         """
         assert self._thread is None, "The USB monitor is already running"
-        self._thread = threading.Thread(name="USB Monitor", target=self._monitor_changes,
-                                        args=(on_connect, on_disconnect, check_every_seconds),
+        assert batch_window_seconds >= 0, f"batch_window_seconds must be positive. Got {batch_window_seconds}"
+        assert max_check_every_seconds is None or max_check_every_seconds >= check_every_seconds, \
+            f"max_check_every_seconds ({max_check_every_seconds}) must be greater or equal than " \
+            f"check_every_seconds ({check_every_seconds})"
+        self._callbacks_queue = queue.Queue(maxsize=_CALLBACKS_QUEUE_MAX_SIZE)
+        # The per-device and the batch callback of each kind of event
+        callbacks_by_event = {_CONNECT_EVENT: (on_connect, on_connect_batch),
+                              _DISCONNECT_EVENT: (on_disconnect, on_disconnect_batch)}
+        self._callbacks_thread = threading.Thread(name="USB Monitor Callbacks", target=self._dispatch_callbacks,
+                                                  args=(self._callbacks_queue, callbacks_by_event,
+                                                        batch_window_seconds),
+                                                  daemon=True)
+        self._callbacks_thread.start()
+        on_connect = self.__enqueued_callback(event=_CONNECT_EVENT, callbacks=callbacks_by_event[_CONNECT_EVENT],
+                                              callbacks_queue=self._callbacks_queue)
+        on_disconnect = self.__enqueued_callback(event=_DISCONNECT_EVENT,
+                                                 callbacks=callbacks_by_event[_DISCONNECT_EVENT],
+                                                 callbacks_queue=self._callbacks_queue)
+        self._thread = threading.Thread(name="USB Monitor", target=self.__run_monitor_thread,
+                                        args=(raise_priority, on_connect, on_disconnect, check_every_seconds,
+                                              max_check_every_seconds),
                                         daemon=True)
         self._thread.start()
 
+    def __run_monitor_thread(self, raise_priority: bool, *monitor_changes_args) -> None:
+        """
+        Entry point of the monitor thread. Raises its priority if requested and runs `_monitor_changes`.
+        :param raise_priority: bool. Whether to raise the scheduling priority of this thread.
+        :param monitor_changes_args: The arguments for `_monitor_changes`.
+        """
+        if raise_priority:
+            self.__raise_current_thread_priority()
+        self._monitor_changes(*monitor_changes_args)
+
+    def __raise_current_thread_priority(self) -> None:
+        """
+        Raises the scheduling priority of the calling thread. On Linux, the udev events are read by this same thread,
+        so they are handled with the raised priority too. Warns if the priority can not be raised.
+        """
+        try:
+            if sys.platform.startswith('linux'):
+                # On Linux, both calls only affect the calling thread
+                try:
+                    os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(_LINUX_MONITOR_RR_PRIORITY))
+                except PermissionError:
+                    os.nice(_LINUX_MONITOR_NICE_INCREMENT)
+            elif sys.platform.startswith('win'):
+                import ctypes
+                kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+                if not kernel32.SetThreadPriority(kernel32.GetCurrentThread(), _WINDOWS_THREAD_PRIORITY_ABOVE_NORMAL):
+                    raise ctypes.WinError(ctypes.get_last_error())
+            else:
+                warn(f"Raising the USB monitor thread priority is not supported on {sys.platform}", RuntimeWarning)
+        except OSError as e:
+            warn(f"Could not raise the USB monitor thread priority: {e}", RuntimeWarning)
+
+    def __enqueued_callback(self, event: str, callbacks: tuple[callable | None, ...],
+                            callbacks_queue: queue.Queue) -> callable | None:
+        """
+        Creates a wrapper that, instead of executing the callbacks of an event, only puts the event in the callbacks
+        queue.
+        :param event: str. The kind of event, _CONNECT_EVENT or _DISCONNECT_EVENT.
+        :param callbacks: tuple[callable | None, ...]. The callbacks of the event. None values are ignored.
+        :param callbacks_queue: queue.Queue. The queue consumed by the callbacks thread.
+        :return: callable | None. The wrapper, with the signature wrapper(device_id, device_info), or None if no
+                callback was given.
+        """
+        if all(callback is None for callback in callbacks):
+            return None
+
+        def enqueue(device_id: str, device_info: dict[str, str | tuple[str, ...]]) -> None:
+            try:
+                callbacks_queue.put_nowait((event, device_id, device_info))
+            except queue.Full:
+                warn(f"USB monitor callbacks queue is full. Dropping the event of the device {device_id}",
+                     RuntimeWarning)
+        return enqueue
+
+    def _dispatch_callbacks(self, callbacks_queue: queue.Queue,
+                            callbacks_by_event: dict[str, tuple[callable | None, callable | None]],
+                            batch_window_seconds: int | float = 0.) -> None:
+        """
+        Executes the callbacks of the events put in the queue, until a None is received. This function should ALWAYS
+        be called from a background thread.
+        :param callbacks_queue: queue.Queue. The queue containing (event, device_id, device_info) tuples.
+        :param callbacks_by_event: dict[str, tuple[callable | None, callable | None]]. The per-device callback and the
+                batch callback (which receives all the devices of a batch at once) of each kind of event.
+        :param batch_window_seconds: int | float. The number of seconds to collect devices for the batch callbacks
+                since the first device of the batch is received.
+        """
+        # Devices waiting for the batch callback of each kind of event, and the time when they will be delivered
+        pending_batches, flush_deadline = {}, None
+        while True:
+            try:
+                timeout = None if flush_deadline is None else max(flush_deadline - time.monotonic(), 0)
+                item = callbacks_queue.get(timeout=timeout)
+            except queue.Empty:
+                self.__flush_batches(pending_batches=pending_batches, callbacks_by_event=callbacks_by_event)
+                flush_deadline = None
+                continue
+            if item is None:
+                self.__flush_batches(pending_batches=pending_batches, callbacks_by_event=callbacks_by_event)
+                break
+            event, device_id, device_info = item
+            callback, batch_callback = callbacks_by_event[event]
+            if callback is not None:
+                try:
+                    callback(device_id, device_info)
+                except Exception as e:
+                    warn(f"USB monitor callback failed for the device {device_id}: {e!r}", RuntimeWarning)
+            if batch_callback is not None:
+                pending_batches.setdefault(event, {})[device_id] = device_info
+                if flush_deadline is None:
+                    flush_deadline = time.monotonic() + batch_window_seconds
+
+    def __flush_batches(self, pending_batches: dict[str, dict[str, dict[str, str | tuple[str, ...]]]],
+                        callbacks_by_event: dict[str, tuple[callable | None, callable | None]]) -> None:
+        """
+        Calls the batch callback of each kind of event with its pending devices, and empties the pending batches.
+        :param pending_batches: dict[str, dict[str, dict[str, str | tuple[str, ...]]]]. The devices waiting for the
+                batch callback of each kind of event.
+        :param callbacks_by_event: dict[str, tuple[callable | None, callable | None]]. See `_dispatch_callbacks`.
+        """
+        for event, devices in pending_batches.items():
+            try:
+                callbacks_by_event[event][1](devices)
+            except Exception as e:
+                warn(f"USB monitor batch callback failed for the devices {tuple(devices)}: {e!r}", RuntimeWarning)
+        pending_batches.clear()
+
     def _monitor_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                             check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None) -> None:
         """
         Monitors the USB devices. This function should ALWAYS be called from a background thread.
         :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
@@ -140,14 +339,32 @@ class _USBDetectorBase(ABC):
                 two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
         :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
                 USB devices. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. The maximum number of seconds to wait between each check
+                when no changes are detected. If None, the interval will always be `check_every_seconds`.
         """
         assert self._thread is not None, "The USB monitor is not running"
         if self._stop_thread.is_set():
             warn("USB monitor can not be started because it is already stopped. Call stop_monitoring() first",
                  RuntimeWarning)
-        while not self._stop_thread.is_set():
-            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
-            self._stop_thread.wait(check_every_seconds)
+            return
+        interval, deadline = check_every_seconds, time.monotonic()
+        while True:
+            removed_devices, added_devices = self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+            # Back off while the system is idle, and go back to the requested interval as soon as something changes
+            if max_check_every_seconds is not None:
+                if len(removed_devices) > 0 or len(added_devices) > 0:
+                    interval = check_every_seconds
+                else:
+                    interval = min(interval * _IDLE_BACKOFF_FACTOR, max_check_every_seconds)
+            # Wait until the next deadline, so the time spent checking doesn't make the checks drift
+            deadline += interval
+            remaining = deadline - time.monotonic()
+            if remaining < -_MAX_CHECKS_DELAY_SECONDS:
+                # Too late to catch up (e.g. after the system was suspended). Start again from now
+                deadline = time.monotonic()
+            # wait() returns True as soon as stop_monitoring() is called. If already late, it just checks the event
+            if self._stop_thread.wait(max(remaining, 0)):
+                break
 
 
     def stop_monitoring(self, warn_if_was_stopped: bool = True, warn_if_timeout: bool = True,
@@ -157,15 +374,42 @@ class _USBDetectorBase(ABC):
         :param warn_if_was_stopped: bool. Whether to warn if the USB monitor was already stopped.
         """
         if self._thread is not None:
+            # The monitor thread waits on this event, so it wakes up immediately instead of finishing its interval
             self._stop_thread.set()
             self._thread.join(timeout=timeout)
-            if warn_if_timeout and self._thread.is_alive():
+            thread_is_alive = self._thread.is_alive()
+            if warn_if_timeout and thread_is_alive:
                 warn(f"USB monitor thread did not stop in {timeout} seconds. "
                      f"It could still be running", RuntimeWarning)
             self._thread = None
+            self.__stop_callbacks_thread(timeout=timeout, warn_if_timeout=warn_if_timeout)
+            # Keep the event set while the old thread is still running, so it still gets the stop signal
+            if thread_is_alive:
+                return
         elif warn_if_was_stopped:
             warn("USB monitor can not be stopped because it is not running", RuntimeWarning)
         self._stop_thread.clear()
 
+    def __stop_callbacks_thread(self, timeout: int | float = _THREAD_JOIN_TIMEOUT_SECONDS,
+                                warn_if_timeout: bool = True) -> None:
+        """
+        Stops the callbacks thread, once it has executed all the callbacks that were already queued.
+        :param timeout: int | float. The maximum number of seconds to wait for the pending callbacks.
+        :param warn_if_timeout: bool. Whether to warn if the callbacks thread did not stop in time.
+        """
+        if self._callbacks_thread is None:
+            return
+        try:
+            self._callbacks_queue.put(None, timeout=timeout)
+            self._callbacks_thread.join(timeout=timeout)
+        except queue.Full:
+            pass
+        if warn_if_timeout and self._callbacks_thread.is_alive():
+            warn(f"USB monitor callbacks thread did not stop in {timeout} seconds. "
+                 f"It could still be running", RuntimeWarning)
+        self._callbacks_thread, self._callbacks_queue = None, None
+
     def __del__(self):
-        self.stop_monitoring(warn_if_was_stopped=False)
\ No newline at end of file
+        # __init__ could have failed before setting the thread (e.g. a missing platform library)
+        if hasattr(self, '_thread'):
+            self.stop_monitoring(warn_if_was_stopped=False)
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+_DeviceNotificationWindow: Hidden message-only window that receives the WM_DEVICECHANGE messages sent by Windows when a
+device interface arrives or is removed. It is used by the _WindowsUSBDetector to be woken up by the system on every
+change, instead of periodically querying WMI.
+"""
+
+from __future__ import annotations
+import ctypes
+from ctypes import wintypes
+
+from ._constants import _WINDOWS_NOTIFICATION_WINDOW_CLASS
+
+# Win32 constants
+_WM_DEVICECHANGE, _DBT_DEVICEARRIVAL, _DBT_DEVICEREMOVECOMPLETE = 0x0219, 0x8000, 0x8004
+_DBT_DEVTYP_DEVICEINTERFACE, _DEVICE_NOTIFY_WINDOW_HANDLE, _DEVICE_NOTIFY_ALL_INTERFACE_CLASSES = 5, 0, 4
+_HWND_MESSAGE, _QS_ALLINPUT, _PM_REMOVE, _WAIT_FAILED = -3, 0x04FF, 0x0001, 0xFFFFFFFF
+
+_LRESULT = wintypes.LPARAM
+_WNDPROC = ctypes.WINFUNCTYPE(_LRESULT, wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM)
+
+
+class _WNDCLASSW(ctypes.Structure):
+    _fields_ = [('style', wintypes.UINT), ('lpfnWndProc', _WNDPROC), ('cbClsExtra', ctypes.c_int),
+                ('cbWndExtra', ctypes.c_int), ('hInstance', wintypes.HINSTANCE), ('hIcon', wintypes.HICON),
+                ('hCursor', wintypes.HANDLE), ('hbrBackground', wintypes.HBRUSH),
+                ('lpszMenuName', wintypes.LPCWSTR), ('lpszClassName', wintypes.LPCWSTR)]
+
+
+class _GUID(ctypes.Structure):
+    _fields_ = [('Data1', wintypes.DWORD), ('Data2', wintypes.WORD), ('Data3', wintypes.WORD),
+                ('Data4', wintypes.BYTE * 8)]
+
+
+class _DEV_BROADCAST_DEVICEINTERFACE_W(ctypes.Structure):
+    _fields_ = [('dbcc_size', wintypes.DWORD), ('dbcc_devicetype', wintypes.DWORD),
+                ('dbcc_reserved', wintypes.DWORD), ('dbcc_classguid', _GUID), ('dbcc_name', wintypes.WCHAR * 1)]
+
+
+class _DeviceNotificationWindow:
+    def __init__(self, callback: callable):
+        """
+        Creates the window and registers it for the notifications of every device interface class. Registering only
+        for GUID_DEVINTERFACE_USB_DEVICE would miss the children of USB devices (e.g. USBSTOR disks, USBPRINT printers
+        or the MI_xx interfaces of composite devices), as they arrive later through other interface classes. Messages
+        are delivered to the thread that creates it, so it must be created, pumped and closed from the same thread.
+        :param callback: callable. Function without arguments, called every time a device interface arrives or is
+                removed.
+        :raises OSError: If the window or the notifications could not be created.
+        """
+        self._user32 = ctypes.WinDLL('user32', use_last_error=True)
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.GetModuleHandleW.restype, kernel32.GetModuleHandleW.argtypes = wintypes.HMODULE, [wintypes.LPCWSTR]
+        self.__declare_functions()
+        self._callback = callback
+        self._instance = kernel32.GetModuleHandleW(None)
+        self._hwnd, self._notification = None, None
+        # The window procedure must be kept alive as long as the window exists
+        self._window_procedure = _WNDPROC(self.__window_procedure)
+        # One class per window, so each window gets its own procedure
+        self._class_name = f"{_WINDOWS_NOTIFICATION_WINDOW_CLASS}_{id(self)}"
+        window_class = _WNDCLASSW(lpfnWndProc=self._window_procedure, hInstance=self._instance,
+                                  lpszClassName=self._class_name)
+        if not self._user32.RegisterClassW(ctypes.byref(window_class)):
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            self._hwnd = self._user32.CreateWindowExW(0, self._class_name, None, 0, 0, 0, 0, 0, _HWND_MESSAGE,
+                                                      None, self._instance, None)
+            if not self._hwnd:
+                raise ctypes.WinError(ctypes.get_last_error())
+            # The class GUID is ignored when registering for all the interface classes
+            notification_filter = _DEV_BROADCAST_DEVICEINTERFACE_W(
+                dbcc_size=ctypes.sizeof(_DEV_BROADCAST_DEVICEINTERFACE_W),
+                dbcc_devicetype=_DBT_DEVTYP_DEVICEINTERFACE)
+            self._notification = self._user32.RegisterDeviceNotificationW(
+                self._hwnd, ctypes.byref(notification_filter),
+                _DEVICE_NOTIFY_WINDOW_HANDLE | _DEVICE_NOTIFY_ALL_INTERFACE_CLASSES)
+            if not self._notification:
+                raise ctypes.WinError(ctypes.get_last_error())
+        except OSError:
+            self.close()
+            raise
+
+    def pump_messages(self, timeout_seconds: int | float) -> None:
+        """
+        Waits until the window receives a message or the timeout expires, and dispatches all the pending messages.
+        :param timeout_seconds: int | float. The maximum number of seconds to wait for a message.
+        """
+        result = self._user32.MsgWaitForMultipleObjects(0, None, False, int(timeout_seconds * 1000), _QS_ALLINPUT)
+        if result == _WAIT_FAILED:
+            raise ctypes.WinError(ctypes.get_last_error())
+        message = wintypes.MSG()
+        while self._user32.PeekMessageW(ctypes.byref(message), None, 0, 0, _PM_REMOVE):
+            self._user32.TranslateMessage(ctypes.byref(message))
+            self._user32.DispatchMessageW(ctypes.byref(message))
+
+    def close(self) -> None:
+        """
+        Unregisters the notifications and destroys the window.
+        """
+        if self._notification:
+            self._user32.UnregisterDeviceNotification(self._notification)
+        if self._hwnd:
+            self._user32.DestroyWindow(self._hwnd)
+        self._user32.UnregisterClassW(self._class_name, self._instance)
+        self._hwnd, self._notification = None, None
+
+    def __window_procedure(self, hwnd, message, wparam, lparam):
+        if message == _WM_DEVICECHANGE and wparam in (_DBT_DEVICEARRIVAL, _DBT_DEVICEREMOVECOMPLETE):
+            self._callback()
+            return True
+        return self._user32.DefWindowProcW(hwnd, message, wparam, lparam)
+
+    def __declare_functions(self) -> None:
+        user32, w = self._user32, wintypes
+        for function, restype, argtypes in (
+                (user32.RegisterClassW, w.ATOM, [ctypes.POINTER(_WNDCLASSW)]),
+                (user32.UnregisterClassW, w.BOOL, [w.LPCWSTR, w.HINSTANCE]),
+                (user32.CreateWindowExW, w.HWND, [w.DWORD, w.LPCWSTR, w.LPCWSTR, w.DWORD, ctypes.c_int, ctypes.c_int,
+                                                 ctypes.c_int, ctypes.c_int, w.HWND, w.HMENU, w.HINSTANCE,
+                                                 w.LPVOID]),
+                (user32.DestroyWindow, w.BOOL, [w.HWND]),
+                (user32.DefWindowProcW, _LRESULT, [w.HWND, w.UINT, w.WPARAM, w.LPARAM]),
+                (user32.RegisterDeviceNotificationW, w.HANDLE, [w.HANDLE, w.LPVOID, w.DWORD]),
+                (user32.UnregisterDeviceNotification, w.BOOL, [w.HANDLE]),
+                (user32.MsgWaitForMultipleObjects, w.DWORD, [w.DWORD, ctypes.POINTER(w.HANDLE), w.BOOL, w.DWORD,
+                                                            w.DWORD]),
+                (user32.PeekMessageW, w.BOOL, [ctypes.POINTER(w.MSG), w.HWND, w.UINT, w.UINT, w.UINT]),
+                (user32.TranslateMessage, w.BOOL, [ctypes.POINTER(w.MSG)]),
+                (user32.DispatchMessageW, _LRESULT, [ctypes.POINTER(w.MSG)])):
+            function.restype, function.argtypes = restype, argtypes
@@ -11,22 +11,42 @@ Github: https://github.com/Eric-Canas
 """
 
 from __future__ import annotations
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from warnings import warn
 
-from ..attributes import DEVTYPE
-from ._constants import _DEVICE_ID, _LINUX_TO_WINDOWS_ATTRIBUTES, _SECONDS_BETWEEN_CHECKS, \
-    _WINDOWS_USB_REGEX_ATTRIBUTES, \
-    _WINDOWS_NON_USB_DEVICES_IDS, _WINDOWS_USB_QUERY, _WINDOWS_TO_LOWERCASE_ATTRIBUTES, \
-    _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER
+# The package imports this module on every OS, but pywin32 and wmi are only installed (and this detector only used)
+# on Windows
+try:
+    import pythoncom
+    import wmi
+except ImportError:
+    pythoncom, wmi = None, None
+
+from ..attributes import DEVTYPE, ID_SERIAL
+from ._constants import _DEVICE_ID, _LINUX_TO_WINDOWS_ATTRIBUTES_ITEMS, _SECONDS_BETWEEN_CHECKS, \
+    _WINDOWS_USB_QUERY, _WINDOWS_TO_LOWERCASE_ATTRIBUTES, \
+    _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER, _WINDOWS_FUSED_REGEX_BY_DRIVER, _WINDOWS_USB_EVENTS_QUERY, \
+    _WINDOWS_DEVICE_SETTLE_SECONDS, _WINDOWS_DEVICE_FINGERPRINT_ATTRIBUTES
 
 from ._usb_detector_base import _USBDetectorBase
 
 
 class _WindowsUSBDetector(_USBDetectorBase):
+    # Whether each thread has already initialized COM through __create_wmi_interface
+    _com_state = threading.local()
+
     def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None):
+        if pythoncom is None or wmi is None:
+            raise ImportError("The Windows USB detector requires the pywin32 and wmi packages. "
+                              "Install them with: pip install pywin32 wmi")
         self._wmi_interface = None
-        # CONSTANTS
+        # Device information already read from WMI, keyed by (DeviceID, fingerprint). Avoids re-reading the attributes
+        # of known devices, while still refreshing them if their fingerprint changes
+        self._device_info_cache = {}
+        # Keys of the devices found by the last query and the (unfiltered) devices built for them
+        self._last_device_keys, self._last_devices = None, {}
         super(_WindowsUSBDetector, self).__init__(filter_devices=filter_devices)
 
     def get_available_devices(self) -> dict[str, dict[str, str]]:
@@ -38,18 +58,34 @@ class _WindowsUSBDetector(_USBDetectorBase):
         """
         if self._wmi_interface is None:
             self._wmi_interface = self.__create_wmi_interface()
-        devices = self._wmi_interface.query(_WINDOWS_USB_QUERY)
-        devices = {getattr(device, _DEVICE_ID): {new_name: getattr(device, attribute)
-                                                 for new_name, attribute in _LINUX_TO_WINDOWS_ATTRIBUTES.items()}
-                    for device in devices}
-        devices = self.__filter_devices(devices=devices)
-        devices = self.__finetune_incompatible_attributes(devices=devices)
+        wmi_devices = self._wmi_interface.query(_WINDOWS_USB_QUERY)
+        device_keys = tuple((getattr(device, _DEVICE_ID),
+                             tuple(getattr(device, attribute) for attribute in _WINDOWS_DEVICE_FINGERPRINT_ATTRIBUTES))
+                            for device in wmi_devices)
+        # Most of the queries find the same devices, unchanged. Then, the last devices are still valid
+        if frozenset(device_keys) != self._last_device_keys:
+            device_info_cache, devices = {}, {}
+            for device_key, device in zip(device_keys, wmi_devices):
+                device_info = self._device_info_cache.get(device_key)
+                # Only the devices that were not seen before (or that changed) need to be read and transformed
+                if device_info is None:
+                    device_info = {new_name: getattr(device, attribute)
+                                   for new_name, attribute in _LINUX_TO_WINDOWS_ATTRIBUTES_ITEMS}
+                    device_info = self.__finetune_incompatible_attributes(device_id=device_key[0],
+                                                                          device_info=device_info)
+                device_info_cache[device_key] = devices[device_key[0]] = device_info
+            # Keep only the devices that are still connected in the cache. They are never modified, so can be shared
+            self._device_info_cache = device_info_cache
+            self._last_device_keys, self._last_devices = frozenset(device_keys), devices
+        # The filter is applied on every call, as it can be changed after the construction
         if self.filter_devices is not None:
-            devices = self._apply_devices_filter(devices=devices)
-        return devices
+            return self._apply_devices_filter(devices=self._last_devices)
+        # The last devices are never returned themselves, as the returned dict must always be a new one
+        return self._last_devices.copy()
 
     def _monitor_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None) -> None:
         """
         Monitors the USB devices. This function should ALWAYS be called from a background thread.
         :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
@@ -58,58 +94,129 @@ class _WindowsUSBDetector(_USBDetectorBase):
                 two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
         :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
                 USB devices. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. The maximum number of seconds to wait between each check
+                when no changes are detected. Only used when falling back to polling.
         """
         # If running this in a background thread, we MUST create the WMI interface inside the thread.
-        self._wmi_interface = self.__create_wmi_interface()
-        super(_WindowsUSBDetector, self)._monitor_changes(on_connect=on_connect, on_disconnect=on_disconnect,
-                                                         check_every_seconds=check_every_seconds)
-
-    def __filter_devices(self, devices: dict[str, dict[str, tuple[str]|str]]) -> dict[str, dict[str, tuple[str]|str]]:
-        """
-        Filters the devices to only include the ones that are USB devices.
-        :param devices: dict[str, dict[str, str]]. The dictionary of devices to filter.
-        :return: dict[str, dict[str, str]]. The filtered devices.
-        """
-        return {device_id: device_info for device_id, device_info in devices.items()
-                if not any(substring in device_info[DEVTYPE] for substring in _WINDOWS_NON_USB_DEVICES_IDS)}
-
-    def __finetune_incompatible_attributes(self, devices: dict[str, dict[str | tuple[str, ...]]]) -> dict[str, dict[str, str]]:
-        """
-        Transforms some attributes to be more similar to the Linux attributes.
-        :param devices: dict[str, str|tuple[str,...]]. The dictionary of devices to transform.
-        :return: dict[str, dict[str, str]]. The transformed devices.
-        """
-        for device_id, device_info in devices.items():
-            driver_type = self.__get_driver_type_from_device_id(device_id=device_id)
-            new_attributes = {attribute: self.__apply_regex(value=device_id, regex=regex)#device_info[attribute], regex)
-                              for attribute, regex in _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER[driver_type].items()
-                              if attribute in device_info}
-            device_info.update(new_attributes)
-            new_attributes = {attr: device_info[attr].upper() for attr in _WINDOWS_TO_LOWERCASE_ATTRIBUTES}
-            device_info.update(new_attributes)
-        return devices
-
-    def __apply_regex(self, value: tuple[str] | str, regex: str) -> str:
-        """
-        Apply the regex to a value, taking into account if it is a tuple or not.
-        :param value: tuple[str] | str. The value to apply the regex to.
-        :param regex: str. The regex to apply.
-        :return: str. The value after applying the regex.
-        """
-        if isinstance(value, str):
-            value = (value,)
-        values_found = []
-        for value in value:
-            match = re.search(regex, value)
-            if match is not None:
-                values_found.append(match.group(1))
-        # If no value was found, return the original value
-        if len(values_found) == 0:
-            warn(f"Could not find a value for the regex '{regex}' in the value '{value}'")
-            return value
-        # Otherwise, return check there are no inconsistencies and return the value
-        assert all(value == values_found[0] for value in values_found), "The values found are not all the same"
-        return values_found[0]
+        self.__replace_wmi_interface()
+        try:
+            if not self.__monitor_device_notifications(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                       check_every_seconds=check_every_seconds):
+                self.__monitor_wmi_events(on_connect=on_connect, on_disconnect=on_disconnect,
+                                          check_every_seconds=check_every_seconds,
+                                          max_check_every_seconds=max_check_every_seconds)
+        finally:
+            self.__release_wmi_interface()
+
+    async def monitor_changes_async(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                                    check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+        """
+        Monitors the USB devices from the running asyncio event loop. WMI can only be used from threads where COM was
+        initialized, so the devices are enumerated in a dedicated thread that creates its own WMI interface.
+        Parameters are the same as in `_USBDetectorBase.monitor_changes_async`.
+        """
+        assert self._thread is None, "The USB monitor is already running in a background thread"
+        self._async_executor = ThreadPoolExecutor(max_workers=1, initializer=self.__replace_wmi_interface)
+        try:
+            await super(_WindowsUSBDetector, self).monitor_changes_async(on_connect=on_connect,
+                                                                         on_disconnect=on_disconnect,
+                                                                         check_every_seconds=check_every_seconds)
+        finally:
+            # The interface must be released from the same thread that created it. Queued tasks still run on shutdown
+            self._async_executor.submit(self.__release_wmi_interface)
+            self._async_executor.shutdown(wait=False)
+            self._async_executor = None
+
+    def __monitor_device_notifications(self, on_connect: callable | None = None,
+                                       on_disconnect: callable | None = None,
+                                       check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> bool:
+        """
+        Calls check_changes every time Windows sends a WM_DEVICECHANGE message for the arrival or removal of a device
+        interface, and keeps checking every `check_every_seconds` for a few seconds after it, so the devices that
+        appear later without a notification of their own are not missed. WMI is only queried around these messages.
+        Parameters are the same as in `_monitor_changes`.
+        :return: bool. False if the notifications could not be registered, so the caller must use another method.
+        """
+        from ._windows_device_notifications import _DeviceNotificationWindow
+        device_events = []
+        try:
+            window = _DeviceNotificationWindow(callback=lambda: device_events.append(True))
+        except OSError as e:
+            warn(f"Could not register for device notifications, falling back to WMI events: {e}", RuntimeWarning)
+            return False
+
+        try:
+            # Catch any change that happened before the window was registered
+            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+            # Outside of the settle time, the timeout is only used to check if stop_monitoring() was called
+            settle_deadline = None
+            while not self._stop_thread.is_set():
+                window.pump_messages(timeout_seconds=check_every_seconds)
+                if len(device_events) > 0:
+                    device_events.clear()
+                    settle_deadline = time.monotonic() + _WINDOWS_DEVICE_SETTLE_SECONDS
+                    self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+                elif settle_deadline is not None:
+                    self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+                    if time.monotonic() >= settle_deadline:
+                        settle_deadline = None
+        finally:
+            window.close()
+        return True
+
+    def __monitor_wmi_events(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                             check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                             max_check_every_seconds: int | float | None = None) -> None:
+        """
+        Calls check_changes every time WMI notifies that a USB device was created or deleted. If the WMI events
+        subscription fails, it falls back to the polling loop of _USBDetectorBase.
+        Parameters are the same as in `_monitor_changes`.
+        """
+        try:
+            watcher = self._wmi_interface.watch_for(raw_wql=_WINDOWS_USB_EVENTS_QUERY)
+        except wmi.x_wmi as e:
+            warn(f"Could not subscribe to WMI device events, falling back to polling: {e}", RuntimeWarning)
+            super(_WindowsUSBDetector, self)._monitor_changes(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                             check_every_seconds=check_every_seconds,
+                                                             max_check_every_seconds=max_check_every_seconds)
+            return
+
+        # Catch any change that happened before the subscription was created
+        self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+        # Only query the devices again when WMI notifies a creation or deletion of a USB device.
+        # The timeout is only used to check if stop_monitoring() was called.
+        while not self._stop_thread.is_set():
+            try:
+                watcher(timeout_ms=int(check_every_seconds * 1000))
+            except wmi.x_wmi_timed_out:
+                pythoncom.PumpWaitingMessages()
+                continue
+            self.check_changes(on_connect=on_connect, on_disconnect=on_disconnect)
+
+    def __finetune_incompatible_attributes(self, device_id: str, device_info: dict[str, str]) -> dict[str, str]:
+        """
+        Transforms some attributes of a device to be more similar to the Linux attributes.
+        :param device_id: str. The device ID.
+        :param device_info: dict[str, str]. The device information to transform. It is modified in place.
+        :return: dict[str, str]. The transformed device information.
+        """
+        driver_type = self.__get_driver_type_from_device_id(device_id=device_id)
+        # Find all the attributes in a single scan. Only the first value found for each one is kept
+        found_attributes = {}
+        for match in _WINDOWS_FUSED_REGEX_BY_DRIVER[driver_type].finditer(device_id):
+            found_attributes.setdefault(match.lastgroup, match.group(match.lastgroup))
+        for attribute in _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER[driver_type]:
+            if attribute in device_info:
+                if attribute not in found_attributes:
+                    warn(f"Could not find the {attribute} in the device ID '{device_id}'")
+                device_info[attribute] = found_attributes.get(attribute, device_id)
+        # Device IDs look like DRIVER\VID_XXXX&PID_XXXX\SERIAL
+        _, separator, serial = device_id.rpartition('\\')
+        device_info[DEVTYPE] = driver_type
+        device_info[ID_SERIAL] = serial if separator and serial else device_id
+        for attribute in _WINDOWS_TO_LOWERCASE_ATTRIBUTES:
+            device_info[attribute] = device_info[attribute].upper()
+        return device_info
 
     def __get_driver_type_from_device_id(self, device_id: str) -> str:
         """
@@ -117,16 +224,37 @@ class _WindowsUSBDetector(_USBDetectorBase):
         :param device_id: str. The device ID.
         :return: str. The driver type.
         """
-        device_splitted_info = device_id.split('\\')
-        assert len(device_splitted_info) >= 1, f"The device ID '{device_id}' is not valid"
-        driver_type = device_splitted_info[0]
+        # Only the first component is needed, so the rest of the ID is not split
+        driver_type = device_id.partition('\\')[0]
         assert driver_type in _WINDOWS_REGEX_ATTRIBUTES_BY_DRIVER, f"The driver type '{driver_type}' is not supported " \
                                                                    f"yet, please create an issue in github"
         return driver_type
 
+    def __replace_wmi_interface(self) -> None:
+        """
+        Replaces the WMI interface by a new one created in the current thread.
+        """
+        self._wmi_interface = self.__create_wmi_interface()
+
+    def __release_wmi_interface(self) -> None:
+        """
+        Releases the WMI interface before uninitializing COM on the current thread. It will be lazily re-created.
+        """
+        self._wmi_interface = None
+        if getattr(_WindowsUSBDetector._com_state, 'initialized', False):
+            _WindowsUSBDetector._com_state.initialized = False
+            pythoncom.CoUninitialize()
+
     def __create_wmi_interface(self):
-        from pythoncom import CoInitialize
-        CoInitialize()
-        import wmi
+        # Initialize COM only once per thread. Every successful call would need its own CoUninitialize
+        if not getattr(_WindowsUSBDetector._com_state, 'initialized', False):
+            try:
+                # Multithreaded apartment, so the WMI objects can be used without marshaling between threads
+                pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+                _WindowsUSBDetector._com_state.initialized = True
+            except pythoncom.com_error:
+                # COM was already initialized in this thread with another concurrency model (e.g. a GUI thread).
+                # It was not initialized by this call, so it must not be uninitialized either
+                pass
         # If running this in a background thread, we MUST create the WMI interface inside the thread.
         return wmi.WMI()
\ No newline at end of file
@@ -10,14 +10,16 @@ Github: https://github.com/Eric-Canas
 """
 
 from __future__ import annotations
-from .__platform_specific_detectors._constants import _SECONDS_BETWEEN_CHECKS, _THREAD_JOIN_TIMEOUT_SECONDS
+from .__platform_specific_detectors._constants import _SECONDS_BETWEEN_CHECKS, _THREAD_JOIN_TIMEOUT_SECONDS, \
+    _LIBUSB_BACKEND
 from warnings import warn
 
 import sys
 
 
 class USBMonitor:
-    def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None):
+    def __init__(self, filter_devices: list[dict[str, str]] | tuple[dict[str, str]] | None = None,
+                 subsystem: str = 'usb', backend: str | None = None):
         """
         Creates a new USBMonitor object. This object can be used to monitor USB devices connected to the system.
 
@@ -26,10 +28,24 @@ class USBMonitor:
         must contain the same keys as the dictionaries returned by the `get_available_devices` method.
         For example, if you want to only monitor devices with ID_MODEL_ID = "A2B2" or "ABCD" you could pass
         filter_devices=({"ID_MODEL_ID": "A2B2"}, {"ID_MODEL_ID": "ABCD"}).
+        :param subsystem: str. (Linux only) The udev subsystem of the devices to list and monitor. Defaults to 'usb'.
+        Use, for example, 'tty' to only get the USB serial ports, notified once they are actually ready to be opened.
+        :param backend: str | None. The backend used to detect the devices. If None, the native one of the OS will be
+        used (udev on Linux, WMI on Windows and the I/O Registry on MacOS). Use 'libusb' to use libusb on any OS
+        (requires the libusb1 package). Defaults to None.
         """
-        if sys.platform.startswith('linux'):
+        if subsystem != 'usb' and (backend is not None or not sys.platform.startswith('linux')):
+            warn(f"The subsystem parameter is only supported by the default Linux backend. "
+                 f"Ignoring subsystem='{subsystem}'")
+
+        if backend == _LIBUSB_BACKEND:
+            from .__platform_specific_detectors._libusb_usb_detector import _LibUSBDetector
+            self.monitor = _LibUSBDetector(filter_devices=filter_devices)
+        elif backend is not None:
+            raise ValueError(f"Unknown backend: '{backend}'. Use None or '{_LIBUSB_BACKEND}'")
+        elif sys.platform.startswith('linux'):
             from .__platform_specific_detectors._linux_usb_detector import _LinuxUSBDetector
-            self.monitor = _LinuxUSBDetector(filter_devices=filter_devices)
+            self.monitor = _LinuxUSBDetector(filter_devices=filter_devices, subsystem=subsystem)
         elif sys.platform.startswith('win'):
             from .__platform_specific_detectors._windows_usb_detector import _WindowsUSBDetector
             self.monitor = _WindowsUSBDetector(filter_devices=filter_devices)
@@ -52,7 +68,7 @@ class USBMonitor:
         return self.monitor.get_available_devices()
 
     def check_changes(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
-                      update_last_check_devices: bool = True) -> None:
+                      update_last_check_devices: bool = True) -> tuple[dict[str, str], dict[str, str]]:
         """
         Checks for changes in the USB devices. If a device is removed, the `on_disconnect` function will be called
         with the device ID as the first argument and the device information as the second argument. If a device is
@@ -62,9 +78,11 @@ class USBMonitor:
         :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to
                 receive two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
         :param update_last_check_devices: bool. Whether to update the last checked devices to the current devices
+        :return: tuple[dict[str, str], dict[str, str]]. The removed and the added devices, as returned by
+                `changes_from_last_check`.
         """
-        self.monitor.check_changes(on_connect=on_connect, on_disconnect=on_disconnect,
-                                   update_last_check_devices=update_last_check_devices)
+        return self.monitor.check_changes(on_connect=on_connect, on_disconnect=on_disconnect,
+                                          update_last_check_devices=update_last_check_devices)
 
     def changes_from_last_check(self, update_last_check_devices: bool = True) -> tuple[dict[str, str], dict[str, str]]:
         """
@@ -77,24 +95,64 @@ class USBMonitor:
         return self.monitor.changes_from_last_check(update_last_check_devices=update_last_check_devices)
 
     def start_monitoring(self, on_connect: callable|None = None, on_disconnect: callable|None = None,
-                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+                         check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS,
+                         max_check_every_seconds: int | float | None = None, raise_priority: bool = False,
+                         on_connect_batch: callable | None = None, on_disconnect_batch: callable | None = None,
+                         batch_window_seconds: int | float = 0.) -> None:
         """
         Starts monitoring the USB devices. This function will trigger a background thread that will check for changes
         in the USB devices every `check_every_seconds` seconds. If a device is removed, the `on_disconnect` function
         will be called with the device ID as the first argument and the device information as the second argument.
-        If a device is added, the `on_connect` function with the same arguments.
+        If a device is added, the `on_connect` function with the same arguments. Callbacks are executed by their own
+        background thread, so a slow callback does not delay the detection of the next changes.
         :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
                 arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
         :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
                 two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
         :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
                 USB devices. Defaults to 0.5 seconds.
+        :param max_check_every_seconds: int | float | None. If given, the time between checks will progressively grow
+                up to this value while no changes are detected, and will go back to `check_every_seconds` as soon as
+                a change is found. It reduces the load on idle systems at the cost of a higher detection latency.
+                Only used by the detectors that poll for changes. Defaults to None (fixed interval).
+        :param raise_priority: bool. Whether to raise the scheduling priority of the monitor thread, so USB changes are
+                detected without delay even when the CPU is busy. On Linux it requires the CAP_SYS_NICE capability
+                (it warns if it can not be raised). Defaults to False.
+        :param on_connect_batch: callable | None. The function to call with all the devices added within the same
+                batch window, instead of one by one. It is expected to receive a single argument, a dictionary with
+                the device IDs as keys and the device information as values. on_connect_batch(devices: dict[str, dict[str, str]])
+        :param on_disconnect_batch: callable | None. The same as `on_connect_batch`, for the removed devices.
+        :param batch_window_seconds: int | float. The number of seconds to keep collecting changes for the batch
+                callbacks after the first one arrives (e.g. when a hub with many devices is plugged). With 0, only
+                the changes detected together are batched. Defaults to 0.
         """
-        if on_connect is None and on_disconnect is None:
+        if all(callback is None for callback in (on_connect, on_disconnect, on_connect_batch, on_disconnect_batch)):
             warn("You are starting the monitor without any callback functions. This won't notice anything "
                  "when a device is connected or disconnected.")
         self.monitor.start_monitoring(on_connect=on_connect, on_disconnect=on_disconnect,
-                                      check_every_seconds=check_every_seconds)
+                                      check_every_seconds=check_every_seconds,
+                                      max_check_every_seconds=max_check_every_seconds,
+                                      raise_priority=raise_priority, on_connect_batch=on_connect_batch,
+                                      on_disconnect_batch=on_disconnect_batch,
+                                      batch_window_seconds=batch_window_seconds)
+
+    async def monitor_changes_async(self, on_connect: callable | None = None, on_disconnect: callable | None = None,
+                                    check_every_seconds: int | float = _SECONDS_BETWEEN_CHECKS) -> None:
+        """
+        Monitors the USB devices from the running asyncio event loop, instead of starting a background thread. The
+        callbacks are called from the event loop, so they must not block it. It runs until the task is cancelled.
+        :param on_connect: callable | None. The function to call when a device is added. It is expected to receive two
+                arguments, the device ID and the device information. on_connect(device_id: str, device_info: dict[str, str])
+        :param on_disconnect: callable | None. The function to call when a device is removed. It is expected to receive
+                two arguments, the device ID and the device information. on_disconnect(device_id: str, device_info: dict[str, str])
+        :param check_every_seconds: int | float. The number of seconds to wait between each check for changes in the
+                USB devices, when they are detected by polling. Defaults to 0.5 seconds.
+        """
+        if on_connect is None and on_disconnect is None:
+            warn("You are starting the monitor without any callback functions. This won't notice anything "
+                 "when a device is connected or disconnected.")
+        await self.monitor.monitor_changes_async(on_connect=on_connect, on_disconnect=on_disconnect,
+                                                 check_every_seconds=check_every_seconds)
 
     def stop_monitoring(self, timeout=_THREAD_JOIN_TIMEOUT_SECONDS) -> None:
         """